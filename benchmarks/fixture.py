@@ -0,0 +1,95 @@
+'Synthetic item catalog of realistic size, built in memory without database'
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from catalog import BONUS_STATS, RESIST_TYPE, ItemCatalog
+from character import CLASS_MAP, RACE_MAP
+
+# InventoryType and how common items of it are, roughly as in item_template
+INVENTORY_TYPES = {1: 6, 2: 3, 3: 5, 4: 4, 5: 6, 6: 5, 7: 6, 8: 6, 9: 5, 10: 5, 11: 4, 12: 2,
+                   13: 6, 14: 3, 15: 2, 16: 5, 17: 5, 20: 2, 21: 2, 22: 2, 25: 1, 26: 1, 28: 1}
+
+# poor and common items are the most frequent ones
+QUALITY = {0: 20, 1: 25, 2: 30, 3: 15, 4: 8, 5: 2}
+
+# stat_type values with stats, 0 is an empty pair
+STAT_TYPES = (0, 1, 3, 4, 5, 6, 7)
+
+
+def _choice(rng, weights, size):
+    keys = np.array(list(weights))
+    p = np.array(list(weights.values()), dtype=float)
+    return rng.choice(keys, size, p=p / p.sum())
+
+
+def spell_names(rng, n_spells=3000):
+    'Spell names and base points, most of them are bonuses parsed by catalog'
+    bonus = rng.integers(len(BONUS_STATS), size=n_spells)
+    value = rng.integers(1, 60, size=n_spells)
+    kind = rng.random(n_spells)
+    names = np.array(['{} {}'.format(BONUS_STATS[b], v) if k < .5 else
+                      BONUS_STATS[b] if k < .85 else 'Proc Effect {}'.format(i)
+                      for i, (b, v, k) in enumerate(zip(bonus, value, kind))], dtype=object)
+    return names, rng.integers(0, 40, size=n_spells)
+
+
+def synthetic_items(n_items=20000, seed=0):
+    'Frame with the columns of catalog.ITEMS_QUERY'
+    rng = np.random.default_rng(seed)
+    items = {'id': np.arange(1, n_items + 1) * 7 + 10000,
+             'name': np.array(['Item {}'.format(i) for i in range(n_items)], dtype=object),
+             'AllowableClass': np.where(rng.random(n_items) < .85, -1,
+                                        rng.choice(list(CLASS_MAP.values()), n_items)),
+             'InventoryType': _choice(rng, INVENTORY_TYPES, n_items),
+             'subclass': rng.integers(0, 5, size=n_items),
+             'Quality': _choice(rng, QUALITY, n_items),
+             'bonding': rng.integers(0, 5, size=n_items)}
+    items['armor'] = np.where(rng.random(n_items) < .6, rng.integers(0, 700, size=n_items), 0)
+    for resist_type in RESIST_TYPE:
+        items[resist_type] = np.where(rng.random(n_items) < .05, rng.integers(1, 30, size=n_items), 0)
+    for i in range(1, 6):
+        has = rng.random(n_items) < .6 / i
+        items['stat_type{}'.format(i)] = np.where(has, rng.choice(STAT_TYPES[1:], n_items), 0)
+        items['stat_value{}'.format(i)] = np.where(has, rng.integers(1, 30, size=n_items), 0)
+    for i in range(1, 4):
+        has = rng.random(n_items) < (.3 if i == 1 else .02)
+        dmg_min = np.where(has, rng.integers(1, 150, size=n_items), 0).astype(float)
+        items['dmg_min{}'.format(i)] = dmg_min
+        items['dmg_max{}'.format(i)] = dmg_min + np.where(has, rng.integers(1, 150, size=n_items), 0)
+        items['dmg_type{}'.format(i)] = np.where(has, rng.integers(0, 7, size=n_items), 0)
+    items['delay'] = np.where(items['dmg_min1'] > 0, rng.integers(1200, 3800, size=n_items), 0)
+
+    names, points = spell_names(rng)
+    for i in range(1, 4):
+        has = rng.random(n_items) < .35 / i
+        spell = rng.integers(len(names), size=n_items)
+        items['spelltrigger_{}'.format(i)] = np.where(has, 1, 0)
+        items['sp{}'.format(i)] = pd.Series(np.where(has, names[spell], None), dtype=object)
+        items['spb{}'.format(i)] = pd.Series(np.where(has, points[spell], np.nan))
+    return pd.DataFrame(items)
+
+
+def synthetic_base_tables():
+    'Level 60 rows of player_classlevelstats and player_levelstats for every class and race'
+    classes, races = list(CLASS_MAP.values()), list(RACE_MAP.values())
+    base_hp_mana = pd.DataFrame({'class': classes, 'level': 60,
+                                 'basehp': [1000 + 60 * c for c in classes],
+                                 'basemana': [900 + 50 * c for c in classes]})
+    pairs = [(c, r) for c in classes for r in races]
+    base_stats = pd.DataFrame({'class': [c for c, _ in pairs], 'race': [r for _, r in pairs], 'level': 60,
+                               'str': [20 + c for c, r in pairs], 'agi': [20 + r for c, r in pairs],
+                               'sta': [25 + (c + r) % 7 for c, r in pairs],
+                               'inte': [20 + (2 * c) % 11 for c, r in pairs],
+                               'spi': [22 + (c * r) % 9 for c, r in pairs]})
+    return base_hp_mana, base_stats
+
+
+def synthetic_catalog(n_items=20000, seed=0):
+    'ItemCatalog with base stats, characters are built from it without database'
+    base_hp_mana, base_stats = synthetic_base_tables()
+    return ItemCatalog(synthetic_items(n_items, seed), base_hp_mana, base_stats, version='synthetic')
@@ -0,0 +1,154 @@
+#! /usr/bin/python3
+'Time hot paths of Character on synthetic catalog and write results as JSON'
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import statistics
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import instrument
+from catalog import ItemCatalog, load_snapshot, set_catalog
+from character import Character, CLASS_MAP, CLASS_REVERSE_MAP, RACE_REVERSE_MAP
+from fixture import synthetic_catalog
+
+
+def timeit(func, repeat, number=1):
+    'Seconds per call of func, one value per repeat'
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+    return timings
+
+
+def wearable(character, catalog, count, seed=0):
+    'Ids of random items character of its class can wear'
+    usable = np.isin(catalog.allowable_class, (-1, CLASS_MAP[character.game_class]))
+    ids = catalog.items['id'].to_numpy()[usable]
+    return np.random.default_rng(seed).choice(ids, count).tolist()
+
+
+def benchmarks(catalog):
+    'Name of benchmark -> (function, number of calls per repeat)'
+    character = Character('prist', 'human')
+    swaps = wearable(character, catalog, 200)
+    geared = Character('warrior', 'orc')
+    for ids in wearable(geared, catalog, 40, seed=1):
+        geared.wear_item(ids)
+    # every class and race present in base stats
+    pairs = [(CLASS_REVERSE_MAP[c], RACE_REVERSE_MAP[r]) for c, r in
+             zip(catalog.base_stats['class'], catalog.base_stats['race'])
+             if c in CLASS_REVERSE_MAP and r in RACE_REVERSE_MAP]
+
+    def construct():
+        for game_class, race in pairs:
+            Character(game_class, race)
+
+    def catalog_build():
+        ItemCatalog(catalog.items, catalog.base_hp_mana, catalog.base_stats, catalog.version)
+
+    def swap():
+        for ids in swaps:
+            character.wear_item(ids)
+        for slot in character.item_type_map:
+            if character.items_on[slot] is not None:
+                character.remove_item(slot)
+
+    def search_all():
+        for slot in character.item_type_map:
+            for quality in ('uncommon', 'rare', 'epic'):
+                character.search(slot, quality=quality)
+
+    def search_cold():
+        # without indexes and readable frame built by earlier searches
+        catalog.search_index = {}
+        catalog.readable = None
+        character.search('chest', quality='epic')
+
+    def summary():
+        geared.summary()
+        geared.summary(hide_resist=True)
+
+    return {
+        'catalog_build': (catalog_build, 1),
+        'character_init': (construct, 1),
+        'wear_remove_swap': (swap, 1),
+        'search_every_slot': (search_all, 1),
+        'search_cold': (search_cold, 1),
+        'human_readable_df': (lambda: character.human_readable_df(character.items), 1),
+        'summary': (summary, 100),
+        'physical_damage_reduction': (geared.physical_damage_reduction, 1000),
+    }
+
+
+def run(catalog, repeat, only=(), profile=''):
+    results = {}
+    for name, (func, number) in benchmarks(catalog).items():
+        if only and name not in only:
+            continue
+        # warm up caches shared between calls, e.g. base tables and search index
+        func()
+        if profile:
+            with instrument.profile(os.path.join(profile, '{}.prof'.format(name))):
+                timeit(func, repeat, number)
+        timings = timeit(func, repeat, number)
+        results[name] = {'best': min(timings), 'median': statistics.median(timings),
+                         'mean': statistics.mean(timings), 'repeat': repeat, 'number': number}
+    return results
+
+
+def compare(results, baseline):
+    'Print change of median time against results of an earlier run'
+    for name, result in results.items():
+        if name in baseline['results']:
+            ratio = result['median'] / baseline['results'][name]['median']
+            print('{:<28} {:>10.6f}s {:>7.2f}x'.format(name, result['median'], ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--items', type=int, default=20000, help='size of synthetic catalog')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--snapshot', default='', help='use snapshot directory instead of synthetic catalog')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', nargs='*', default=(), help='names of benchmarks to run')
+    parser.add_argument('--output', default='', help='JSON file for results, printed if empty')
+    parser.add_argument('--compare', default='', help='JSON file of an earlier run')
+    parser.add_argument('--profile', default='', help='directory for cProfile output of every benchmark')
+    args = parser.parse_args()
+
+    if args.profile:
+        os.makedirs(args.profile, exist_ok=True)
+    if args.snapshot:
+        catalog = load_snapshot(args.snapshot)
+    else:
+        catalog = set_catalog(synthetic_catalog(args.items, args.seed))
+
+    report = {
+        'meta': {'items': int(catalog.items.shape[0]), 'catalog': catalog.version, 'seed': args.seed,
+                 'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                 'machine': platform.machine(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'results': run(catalog, args.repeat, args.only, args.profile),
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f_out:
+            json.dump(report, f_out, indent=2)
+    if args.compare:
+        with open(args.compare) as f_in:
+            compare(report['results'], json.load(f_in))
+    elif not args.output:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
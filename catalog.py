@@ -0,0 +1,565 @@
+import os
+import re
+import json
+import asyncio
+import functools
+import threading
+
+import pandas as pd
+import numpy as np
+from sqlalchemy import bindparam, inspect, text
+
+from changes import touched_keys
+
+BASE_HP_MANA_QUERY = """
+SELECT *
+FROM player_classlevelstats
+WHERE level = 60;
+"""
+
+BASE_STATS_QUERY = """
+SELECT *
+FROM player_levelstats
+WHERE level = 60;
+"""
+
+SNAPSHOT_TABLES = ('items', 'base_hp_mana', 'base_stats')
+
+# per-item arrays computed from items, stored in snapshot so they are not parsed again
+DERIVED_ARRAYS = ('bonus_index', 'bonus_value', 'deltas')
+
+# table of files applied by fill_db.py and directory they come from
+APPLIED_TABLE = 'applied_files'
+UPDATES_PATH = './updates'
+
+# order is matter, first matched bonus wins
+BONUS_STATS = ('Increase Spell Dam', 'Increase Fire Dam', 'Increase Shadow Dam',
+               'Increase Nature Dam', 'Increase Frost Dam', 'Increase Holy Dam',
+               'Increase Arcane Dam', 'Increase Healing', 'Increased Critical',
+               'Increased Critical Spell', 'Increased Mana Regen', 'Increased Defense',
+               'Increased Dodge', 'Increased Parry', 'Attack Power', 'Increased Hit Chance')
+
+BONUS_ATTR_NAME = ('spell_power', 'spell_fire_power', 'spell_shadow_power',
+                   'spell_nature_power', 'spell_frost_power', 'spell_holy_power',
+                   'spell_arcane_power', 'healing_power', 'base_crit',
+                   'base_spell_crit', 'mana_reg_bonus', 'defence',
+                   'base_dodge', 'parry', 'base_attack_power', 'hit_chance')
+
+RESIST_TYPE = ('holy_res', 'fire_res', 'nature_res',
+               'frost_res', 'shadow_res', 'arcane_res')
+
+# stat_type of item_template to attribute of Character it changes
+STAT_ATTR = {1: 'bonus_hp', 3: 'agi', 4: 'str', 5: 'inte', 6: 'spi', 7: 'sta'}
+
+# attributes of Character changed by an item, columns of ItemCatalog.deltas
+DELTA_ATTRS = ('bonus_hp', 'agi', 'str', 'inte', 'spi', 'sta', 'base_armor') + RESIST_TYPE + BONUS_ATTR_NAME
+
+# columns of ItemCatalog.items by group, a group is read when it is first used
+COLUMN_GROUPS = {
+    'core': ('id', 'name', 'AllowableClass', 'InventoryType', 'subclass', 'Quality', 'bonding'),
+    'stats': ('armor',) + tuple('stat_{}{}'.format(kind, i) for i in range(1, 6) for kind in ('type', 'value')),
+    'resistances': RESIST_TYPE,
+    'weapon': tuple('dmg_{}{}'.format(kind, i) for i in range(1, 4) for kind in ('min', 'max', 'type')) + ('delay',),
+    'spells': tuple(column.format(i) for i in range(1, 4) for column in ('spelltrigger_{}', 'sp{}', 'spb{}')),
+}
+
+# columns that are not item_template columns of the same name
+COLUMN_SQL = {'id': 'entry'}
+COLUMN_SQL.update(('sp{}'.format(i), 's{}.SpellName'.format(i)) for i in range(1, 4))
+COLUMN_SQL.update(('spb{}'.format(i), 's{}.EffectBasePoints1'.format(i)) for i in range(1, 4))
+
+SPELL_JOINS = """
+  LEFT JOIN spell_template as s1 ON spellid_1 = s1.Id
+  LEFT JOIN spell_template as s2 ON spellid_2 = s2.Id
+  LEFT JOIN spell_template as s3 ON spellid_3 = s3.Id
+"""
+
+
+def items_query(columns):
+    'SELECT of given columns of ItemCatalog.items, spell_template is joined only for spell columns'
+    select = ',\n  '.join('{} AS {}'.format(COLUMN_SQL[column], column) if column in COLUMN_SQL else column
+                          for column in columns)
+    query = 'SELECT\n  {}\nFROM item_template'.format(select)
+    if set(columns) & set(COLUMN_GROUPS['spells']):
+        query += SPELL_JOINS
+    return query + '\n'
+
+
+ITEMS_QUERY = items_query(sum(COLUMN_GROUPS.values(), ()))
+
+# rows of items with given ids or using given spells, see ItemCatalog.apply_changes
+CHANGED_ITEMS_QUERY = text(ITEMS_QUERY + """
+WHERE item_template.entry IN :ids
+  OR spellid_1 IN :spells OR spellid_2 IN :spells OR spellid_3 IN :spells
+""").bindparams(bindparam('ids', expanding=True), bindparam('spells', expanding=True))
+
+# spell name is a bonus name optionally followed by its value
+BONUS_PATTERNS = tuple(re.compile(r'{}( \d+)?$'.format(bonus)) for bonus in BONUS_STATS)
+
+
+def parse_bonus(spell_name):
+    'Return index of bonus in BONUS_STATS and value from the end of spell name (or None)'
+    for i, pattern in enumerate(BONUS_PATTERNS):
+        match = pattern.search(spell_name)
+        if match:
+            return i, int(match.group(1)) if match.group(1) else None
+    return -1, None
+
+
+def parse_bonuses(items):
+    'Resolve sp1..sp3 spell names to bonus index and value arrays of shape (items, 3)'
+    bonus_index = np.full((items.shape[0], 3), -1, dtype=np.int64)
+    bonus_value = np.zeros((items.shape[0], 3), dtype=np.int64)
+    for i in range(3):
+        names = items['sp{}'.format(i + 1)]
+        points = items['spb{}'.format(i + 1)].to_numpy()
+        # every distinct spell name is parsed only once
+        parsed = {name: parse_bonus(name) for name in names.dropna().unique()}
+        for row, name in enumerate(names):
+            if name is None or name not in parsed:
+                continue
+            index, value = parsed[name]
+            if index < 0:
+                continue
+            bonus_index[row, i] = index
+            bonus_value[row, i] = points[row] if value is None else value
+    return bonus_index, bonus_value
+
+
+def item_deltas(items, bonus):
+    'Matrix of item x DELTA_ATTRS, how much every item adds to a character'
+    deltas = np.zeros((items.shape[0], len(DELTA_ATTRS)))
+    for i in range(1, 6):
+        types = items['stat_type{}'.format(i)].to_numpy()
+        values = items['stat_value{}'.format(i)].to_numpy()
+        for stat_type, attr in STAT_ATTR.items():
+            rows = types == stat_type
+            deltas[rows, DELTA_ATTRS.index(attr)] += values[rows]
+    deltas[:, DELTA_ATTRS.index('base_armor')] = items['armor'].to_numpy()
+    for resist_type in RESIST_TYPE:
+        deltas[:, DELTA_ATTRS.index(resist_type)] = items[resist_type].to_numpy()
+    deltas[:, len(DELTA_ATTRS) - len(BONUS_ATTR_NAME):] = bonus
+    return deltas
+
+
+class ItemCatalog:
+    '''
+    Joined item_template / spell_template table shared by all Character instances.
+    Columns are kept in COLUMN_GROUPS, groups missing in items are read by
+    loader(columns) when they are first used, e.g. weapon damage by a tank that
+    only compares armor is never read.
+    '''
+    def __init__(self, items, base_hp_mana=None, base_stats=None, version=None, last_update=None, derived=None,
+                 loader=None):
+        # treat as read-only, every character holds a reference to the same frames
+        self.set_items(items)
+        self.loader = loader
+        self.load_lock = threading.Lock()
+        # level 60 rows of player_classlevelstats and player_levelstats,
+        # only present when catalog comes from a snapshot
+        self.base_hp_mana = base_hp_mana
+        self.base_stats = base_stats
+        self.version = version
+        # name of the last update file catalog reflects, see update_catalog
+        self.last_update = last_update
+        # changed every time rows are replaced, caches of item stats compare it
+        self.generation = 0
+
+        # directory of snapshot catalog was read from, see read_snapshot
+        self.snapshot = None
+
+        # spell bonuses of every item are parsed once on first use, rows follow self.items
+        if derived is not None:
+            # arrays of DERIVED_ARRAYS, e.g. memory-mapped from snapshot
+            self._bonus_index, self._bonus_value, self._deltas = derived
+        else:
+            self._bonus_index = self._bonus_value = self._deltas = None
+        self.build_index()
+
+    def set_items(self, items):
+        'Split items into column groups, groups with missing columns are left to loader'
+        self.groups = {name: items[list(columns)] for name, columns in COLUMN_GROUPS.items()
+                       if set(columns) <= set(items.columns)}
+        if 'core' not in self.groups:
+            raise KeyError('Items have no columns {}'.format(COLUMN_GROUPS['core']))
+        self._items = items if len(self.groups) == len(COLUMN_GROUPS) else None
+
+    def group(self, name):
+        'Frame of columns of one of COLUMN_GROUPS, it is read on first use'
+        if name not in self.groups:
+            if name not in COLUMN_GROUPS:
+                print('Valid groups', tuple(COLUMN_GROUPS))
+                raise KeyError('Invalid column group: {}'.format(name))
+            # only the first of concurrent callers reads the group
+            with self.load_lock:
+                if name not in self.groups:
+                    self.groups[name] = self.loader(COLUMN_GROUPS[name])
+        return self.groups[name]
+
+    def columns(self, *names, positions=None):
+        'Frame of columns of given groups, only rows at positions if they are given'
+        if positions is None:
+            return pd.concat([self.group(name) for name in names], axis=1)
+        return pd.concat([self.group(name).iloc[positions] for name in names], axis=1)
+
+    @property
+    def items(self):
+        'All columns of the catalog, every group is loaded'
+        if self._items is None:
+            self._items = self.columns(*COLUMN_GROUPS)
+        return self._items
+
+    @property
+    def bonus_index(self):
+        if self._bonus_index is None:
+            self._bonus_index, self._bonus_value = parse_bonuses(self.group('spells'))
+        return self._bonus_index
+
+    @property
+    def bonus_value(self):
+        if self._bonus_value is None:
+            self._bonus_index, self._bonus_value = parse_bonuses(self.group('spells'))
+        return self._bonus_value
+
+    @property
+    def deltas(self):
+        if self._deltas is None:
+            self._deltas = item_deltas(self.columns('stats', 'resistances'),
+                                       self.item_bonus(self.bonus_index, self.bonus_value))
+        return self._deltas
+
+    @staticmethod
+    def item_bonus(bonus_index, bonus_value):
+        'Item x bonus matrix, columns follow BONUS_ATTR_NAME'
+        bonus = np.zeros((bonus_index.shape[0], len(BONUS_ATTR_NAME)))
+        rows, slots = np.nonzero(bonus_index >= 0)
+        np.add.at(bonus, (rows, bonus_index[rows, slots]), bonus_value[rows, slots])
+        return bonus
+
+    def build_index(self):
+        'Lookup structures derived from rows of items, only core columns are needed'
+        core = self.groups['core']
+        # item id to row position, ids sorted for vectorized lookup
+        ids = core['id'].to_numpy()
+        self.index = dict(zip(ids.tolist(), range(len(ids))))
+        self.order = np.argsort(ids, kind='stable')
+        self.sorted_ids = ids[self.order]
+
+        # compact per-item records used by equip / unequip
+        self.inventory_type = core['InventoryType'].to_numpy()
+        self.allowable_class = core['AllowableClass'].to_numpy()
+
+        # row positions of every (InventoryType, AllowableClass, Quality, subclass)
+        self.partitions = {tuple(int(value) for value in key): positions for key, positions in
+                           core.groupby(['InventoryType', 'AllowableClass', 'Quality', 'subclass']).indices.items()}
+        # unions of partitions already asked by search
+        self.search_index = {}
+        # whole catalog in human readable form, set by Character on first search
+        self.readable = None
+        # columns of human readable form used to sort search results, see Character.sort_column
+        self.sort_columns = {}
+
+    @property
+    def bonus(self):
+        return self.deltas[:, len(DELTA_ATTRS) - len(BONUS_ATTR_NAME):]
+
+    @classmethod
+    def from_db(cls, engine, with_base_stats=False):
+        'Catalog with core columns read, other groups are queried when first used'
+        last_update = last_applied_update(engine)
+        core = pd.read_sql_query(items_query(COLUMN_GROUPS['core']), engine)
+        ids = core['id'].to_numpy()
+        # read_item_columns is looked up on each call, so instrument can time it
+        loader = lambda columns: read_item_columns(engine, ids, columns)
+        if not with_base_stats:
+            return cls(core, last_update=last_update, loader=loader)
+        return cls(core,
+                   base_hp_mana=pd.read_sql_query(BASE_HP_MANA_QUERY, engine),
+                   base_stats=pd.read_sql_query(BASE_STATS_QUERY, engine),
+                   version=content_version(engine),
+                   last_update=last_update,
+                   loader=loader)
+
+    def apply_changes(self, engine, item_ids, spell_ids):
+        '''
+        Query again items with given ids and items using given spells, then
+        replace their rows in place. Items missing in database are dropped.
+        '''
+        rows = pd.read_sql_query(CHANGED_ITEMS_QUERY, engine,
+                                 params={'ids': sorted(item_ids), 'spells': sorted(spell_ids)})
+        self.replace_rows(rows, item_ids)
+        return rows.shape[0]
+
+    def replace_rows(self, rows, removed=()):
+        '''
+        Put rows in place of items with the same ids, items with ids in removed are dropped.
+        Every column group is loaded first, rows of loader would not follow the new order.
+        '''
+        items = self.items
+        ids = items['id'].to_numpy()
+        # old rows of changed items go away, new ones are added at the end
+        keep = ~np.isin(ids, list(removed) + rows['id'].tolist())
+
+        if self._bonus_index is not None:
+            bonus_index, bonus_value = parse_bonuses(rows)
+            self._bonus_index = np.concatenate([self._bonus_index[keep], bonus_index])
+            self._bonus_value = np.concatenate([self._bonus_value[keep], bonus_value])
+            if self._deltas is not None:
+                self._deltas = np.concatenate([self._deltas[keep],
+                                               item_deltas(rows, self.item_bonus(bonus_index, bonus_value))])
+        else:
+            self._deltas = None
+        self.set_items(pd.concat([items[keep], rows[items.columns]], ignore_index=True))
+        self.loader = None
+        # rows no longer match the snapshot, see evaluate_roster
+        self.snapshot = None
+        self.build_index()
+        self.generation += 1
+
+    def position(self, ids):
+        'Row position of item with given id'
+        try:
+            return self.index[ids]
+        except (KeyError, TypeError):
+            raise KeyError('No item with such id.')
+
+    def positions(self, ids):
+        'Row positions of array of item ids'
+        ids = np.asarray(ids)
+        idx = np.searchsorted(self.sorted_ids, ids).clip(0, max(len(self.sorted_ids) - 1, 0))
+        if len(self.sorted_ids) == 0 or not np.all(self.sorted_ids[idx] == ids):
+            raise KeyError('No item with such id.')
+        return self.order[idx]
+
+    def search_positions(self, inventory_types, class_id, quality, subclass=None):
+        'Sorted row positions of items of given slot types and quality usable by the class'
+        key = (tuple(inventory_types), class_id, quality, subclass)
+        if key not in self.search_index:
+            parts = [positions for (item_type, allowable_class, item_quality, item_subclass), positions
+                     in self.partitions.items()
+                     if item_type in inventory_types and allowable_class in (-1, class_id) and
+                     item_quality == quality and (subclass is None or item_subclass == subclass)]
+            self.search_index[key] = np.sort(np.concatenate(parts)) if parts else np.array([], dtype=np.int64)
+        return self.search_index[key]
+
+    def has_base_stats(self):
+        return self.base_hp_mana is not None and self.base_stats is not None
+
+    def base_tables(self, class_id, race_id):
+        'Rows of base hp/mana and base stats for class and race, same as queried from database'
+        base_hp_mana = self.base_hp_mana.loc[self.base_hp_mana['class'] == class_id]
+        base_stats = self.base_stats.loc[(self.base_stats['class'] == class_id) &
+                                         (self.base_stats['race'] == race_id)]
+        return base_hp_mana.reset_index(drop=True), base_stats.reset_index(drop=True)
+
+
+def update_number(name):
+    # updates are named like 1471_tbc_objects.sql, files without number go last
+    number = re.match(r'\d+', name)
+    return (0, int(number.group()), name) if number else (1, 0, name)
+
+
+def applied_updates(engine):
+    'Names of update files applied to database in the order of application'
+    if not inspect(engine).has_table(APPLIED_TABLE):
+        return []
+    names = pd.read_sql_query('SELECT name FROM {}'.format(APPLIED_TABLE), engine)['name']
+    # base dump and its tables are recorded too, updates are the numbered files
+    return sorted((name for name in names if re.match(r'\d+', name)), key=update_number)
+
+
+def last_applied_update(engine):
+    updates = applied_updates(engine)
+    return updates[-1] if updates else None
+
+
+def content_version(engine):
+    'Version of content database, taken from required_* column of db_version table'
+    columns = pd.read_sql_query('SELECT * FROM db_version', engine).columns
+    for column in columns:
+        if column.startswith('required_'):
+            return column[len('required_'):]
+    return 'unknown'
+
+
+def read_item_columns(engine, ids, columns):
+    'Columns of items from database, rows follow ids'
+    frame = pd.read_sql_query(items_query(('id',) + tuple(columns)), engine)
+    return frame.set_index('id').reindex(ids).reset_index(drop=True)
+
+
+def _write_frame(df, path):
+    # one .npy file per column so each of them can be memory-mapped
+    os.makedirs(path, exist_ok=True)
+    columns = []
+    for column in df.columns:
+        if pd.api.types.is_numeric_dtype(df[column]):
+            values, kind = df[column].to_numpy(), 'num'
+        else:
+            # fixed width unicode, None is stored as empty string
+            values, kind = df[column].fillna('').astype(str).to_numpy(dtype=str), 'str'
+        np.save(os.path.join(path, '{}.npy'.format(column)), values)
+        columns.append([column, kind])
+    return columns
+
+
+def _read_frame(path, columns):
+    data = {}
+    for column, kind in columns:
+        values = np.load(os.path.join(path, '{}.npy'.format(column)), mmap_mode='r')
+        if kind == 'str':
+            # strings have to be converted to python objects anyway
+            values = values.astype(object)
+            values[values == ''] = None
+            values = pd.Series(values, dtype=object, copy=False)
+        data[column] = values
+    # copy=False keeps numeric columns backed by the memory-mapped files
+    return pd.DataFrame(data, copy=False)
+
+
+def _read_columns(path, kinds, columns):
+    return _read_frame(path, [[column, kinds[column]] for column in columns])
+
+
+def save_snapshot(engine, path='./snapshot'):
+    'Export catalog and level 60 base stats to path/<content version>, return its directory'
+    return write_snapshot(ItemCatalog.from_db(engine, with_base_stats=True), path)
+
+
+def write_snapshot(catalog, path='./snapshot'):
+    'Write catalog to path/<catalog version>, return its directory'
+    directory = os.path.join(path, catalog.version or 'current')
+    meta = {'version': catalog.version, 'last_update': catalog.last_update, 'tables': {}}
+    for table in SNAPSHOT_TABLES:
+        if getattr(catalog, table) is not None:
+            meta['tables'][table] = _write_frame(getattr(catalog, table), os.path.join(directory, table))
+    os.makedirs(os.path.join(directory, 'derived'), exist_ok=True)
+    for name in DERIVED_ARRAYS:
+        np.save(os.path.join(directory, 'derived', '{}.npy'.format(name)), getattr(catalog, name))
+    meta['derived'] = list(DERIVED_ARRAYS)
+    with open(os.path.join(directory, 'meta.json'), 'w') as f_out:
+        json.dump(meta, f_out)
+    return directory
+
+
+def read_snapshot(path='./snapshot', version=None):
+    'Load catalog from snapshot, the most recent one is used if version is not given'
+    if version is None:
+        versions = [name for name in os.listdir(path)
+                    if os.path.isfile(os.path.join(path, name, 'meta.json'))]
+        if not versions:
+            raise FileNotFoundError('No snapshot in {}'.format(path))
+        version = max(versions, key=lambda name: os.path.getmtime(os.path.join(path, name, 'meta.json')))
+    directory = os.path.join(path, version)
+    with open(os.path.join(directory, 'meta.json')) as f_in:
+        meta = json.load(f_in)
+    tables = {table: _read_frame(os.path.join(directory, table), columns)
+              for table, columns in meta['tables'].items() if table != 'items'}
+    # only core columns of items are read now, other groups when they are first used
+    kinds = dict(meta['tables']['items'])
+    items = os.path.join(directory, 'items')
+    tables['items'] = _read_columns(items, kinds, COLUMN_GROUPS['core'])
+    derived = None
+    if meta.get('derived') == list(DERIVED_ARRAYS):
+        # memory-mapped, processes reading the same snapshot share these pages
+        derived = tuple(np.load(os.path.join(directory, 'derived', '{}.npy'.format(name)), mmap_mode='r')
+                        for name in DERIVED_ARRAYS)
+    catalog = ItemCatalog(tables['items'], tables.get('base_hp_mana'), tables.get('base_stats'),
+                          meta['version'], meta.get('last_update'), derived,
+                          functools.partial(_read_columns, items, kinds))
+    catalog.snapshot = directory
+    return catalog
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def _engine(engine):
+    # engine can be passed as a callable to connect only when it is needed
+    return engine() if callable(engine) else engine
+
+
+def get_catalog(engine):
+    'Return process-wide item catalog, it is loaded from database on first use'
+    global _catalog
+    # double-checked so only the first caller pays for the query
+    if _catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                _catalog = ItemCatalog.from_db(_engine(engine))
+    return _catalog
+
+
+async def get_catalog_async(engine, executor=None):
+    'get_catalog that does not block event loop, first load runs in executor'
+    if _catalog is not None:
+        return _catalog
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, get_catalog, engine)
+
+
+def set_catalog(catalog):
+    'Use given catalog as the process-wide one'
+    global _catalog
+    with _catalog_lock:
+        _catalog = catalog
+    return catalog
+
+
+def load_snapshot(path='./snapshot', version=None):
+    'Make snapshot the process-wide catalog, characters are then built without database'
+    return set_catalog(read_snapshot(path, version))
+
+
+def refresh_catalog(engine):
+    'Reload catalog from database, e.g. after fill_db.py applied new updates'
+    return set_catalog(ItemCatalog.from_db(_engine(engine)))
+
+
+def update_catalog(engine, path=UPDATES_PATH):
+    '''
+    Bring process-wide catalog up to date with update files applied after the last one
+    it reflects. Only item_template / spell_template rows touched by these files are
+    queried and changed in place, catalog is reloaded as a whole when changed rows
+    can not be told from the files.
+    Returns names of update files taken into account.
+    '''
+    catalog = get_catalog(engine)
+    engine = _engine(engine)
+    with _catalog_lock:
+        applied = applied_updates(engine)
+        if catalog.last_update is None:
+            pending = applied
+        else:
+            pending = [name for name in applied if update_number(name) > update_number(catalog.last_update)]
+        if not pending:
+            return []
+
+        item_ids, spell_ids = set(), set()
+        for name in pending:
+            try:
+                with open(os.path.join(path, name), encoding='utf-8', errors='replace') as f_in:
+                    touched = touched_keys(f_in.read())
+            except FileNotFoundError:
+                touched = {'item_template': None, 'spell_template': None}
+            if touched['item_template'] is None or touched['spell_template'] is None:
+                item_ids = None
+                break
+            item_ids |= touched['item_template']
+            spell_ids |= touched['spell_template']
+
+        if item_ids is None or catalog.last_update is None:
+            # rows changed are unknown, every row is read again into the same catalog
+            catalog.replace_rows(pd.read_sql_query(ITEMS_QUERY, engine), catalog.group('core')['id'].tolist())
+        elif item_ids or spell_ids:
+            catalog.apply_changes(engine, item_ids, spell_ids)
+        catalog.last_update = pending[-1]
+    return pending
+
+
+def invalidate_catalog():
+    'Drop cached catalog, next get_catalog call loads it again'
+    global _catalog
+    with _catalog_lock:
+        _catalog = None
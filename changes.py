@@ -0,0 +1,152 @@
+import re
+
+# primary key of tables the catalog is built from
+KEY_COLUMNS = {'item_template': 'entry', 'spell_template': 'Id'}
+
+STATEMENT = re.compile(r'^\s*(INSERT(?:\s+IGNORE)?\s+INTO|REPLACE\s+INTO|UPDATE|DELETE\s+FROM)\s+`?(\w+)`?',
+                       re.IGNORECASE)
+
+
+def statements(sql):
+    'Split sql script into statements, comments are dropped and quotes respected'
+    result, current, quote, i = [], [], None, 0
+    while i < len(sql):
+        char = sql[i]
+        if quote:
+            current.append(char)
+            if char == '\\':
+                current.append(sql[i + 1:i + 2])
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char in '\'"`':
+            quote = char
+            current.append(char)
+        elif sql.startswith('--', i) or char == '#':
+            end = sql.find('\n', i)
+            i = len(sql) if end < 0 else end
+            continue
+        elif sql.startswith('/*', i):
+            end = sql.find('*/', i + 2)
+            i = len(sql) if end < 0 else end + 2
+            continue
+        elif char == ';':
+            result.append(''.join(current).strip())
+            current = []
+        else:
+            current.append(char)
+        i += 1
+    result.append(''.join(current).strip())
+    return [statement for statement in result if statement]
+
+
+def _values(sql):
+    'Rows of VALUES (...), (...) as lists of raw values'
+    rows, row, value, quote, depth = [], [], [], None, 0
+    i = 0
+    while i < len(sql):
+        char = sql[i]
+        if quote:
+            if char == '\\':
+                value.append(sql[i + 1:i + 2])
+                i += 1
+            elif char == quote:
+                quote = None
+            else:
+                value.append(char)
+        elif char in '\'"':
+            quote = char
+        elif char == '(':
+            depth += 1
+            if depth > 1:
+                value.append(char)
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                row.append(''.join(value).strip())
+                rows.append(row)
+                row, value = [], []
+            else:
+                value.append(char)
+        elif char == ',' and depth == 1:
+            row.append(''.join(value).strip())
+            value = []
+        elif depth > 0:
+            value.append(char)
+        i += 1
+    return rows
+
+
+def _where_keys(statement, key):
+    'Keys selected by WHERE clause of statement, None when they can not be told'
+    where = re.search(r'\bWHERE\b(.*)$', statement, re.IGNORECASE | re.DOTALL)
+    if not where or re.search(r'\bOR\b|\bXOR\b|\bNOT\b|\|\|', where.group(1), re.IGNORECASE):
+        return None
+    # key column has to be a condition of its own, f.entry, SpellIconID or entry = 5 - 1 are not
+    column = r'(?:^|\bAND\b|\()\s*`?{}`?\s*'.format(key)
+    end = r'\s*(?=$|\)|;|\bAND\b|\bLIMIT\b|\bORDER\b)'
+    match = re.search(column + r'=\s*\'?(\d+)\'?' + end, where.group(1), re.IGNORECASE)
+    if match:
+        return {int(match.group(1))}
+    match = re.search(column + r'IN\s*\(([\d\s,\']*)\)' + end, where.group(1), re.IGNORECASE)
+    if match:
+        return {int(value.strip(' \'')) for value in match.group(1).split(',') if value.strip(' \'')}
+    match = re.search(column + r'BETWEEN\s+(\d+)\s+AND\s+(\d+)' + end, where.group(1), re.IGNORECASE)
+    if match:
+        return set(range(int(match.group(1)), int(match.group(2)) + 1))
+    return None
+
+
+def _single_table(statement, end):
+    'False when UPDATE or DELETE changes more tables than the one named before end, e.g. by JOIN'
+    tables = re.split(r'\b(?:SET|WHERE)\b', statement[end:], maxsplit=1, flags=re.IGNORECASE)[0]
+    return not re.search(r',|\bJOIN\b|\bUSING\b', tables, re.IGNORECASE)
+
+
+def _insert_keys(statement, key):
+    'Keys of rows inserted by statement, None when they can not be told'
+    match = re.search(r'\bVALUES\b', statement, re.IGNORECASE)
+    if not match:
+        # e.g. INSERT ... SELECT
+        return None
+    columns = re.search(r'`?\w+`?\s*\(([^)]*)\)\s*$', statement[:match.start()])
+    position = 0
+    if columns:
+        names = [name.strip(' `').lower() for name in columns.group(1).split(',')]
+        if key.lower() not in names:
+            return None
+        position = names.index(key.lower())
+    keys = set()
+    for row in _values(statement[match.end():]):
+        try:
+            keys.add(int(row[position]))
+        except (IndexError, ValueError):
+            return None
+    return keys
+
+
+def touched_keys(sql, tables=tuple(KEY_COLUMNS)):
+    '''
+    Keys of rows of tables changed by sql script, dict of table -> set of keys.
+    Set is None when changed rows can not be told, e.g. ALTER TABLE or UPDATE by name.
+    '''
+    touched = {table: set() for table in tables}
+    for statement in statements(sql):
+        match = STATEMENT.match(statement)
+        insert = match and match.group(1).upper().startswith(('INSERT', 'REPLACE'))
+        if match and match.group(2) in touched and (insert or _single_table(statement, match.end())):
+            table = match.group(2)
+            if touched[table] is None:
+                continue
+            key = KEY_COLUMNS[table]
+            if insert:
+                keys = _insert_keys(statement, key)
+            else:
+                keys = _where_keys(statement, key)
+            touched[table] = None if keys is None else touched[table] | keys
+        else:
+            # any other statement that mentions a table, e.g. ALTER, TRUNCATE or UPDATE of joined tables
+            for table in touched:
+                if re.search(r'\b{}\b'.format(table), statement):
+                    touched[table] = None
+    return touched
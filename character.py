@@ -1,113 +1,186 @@
 import os
-import re
-import configparser
+import copy
+import struct
+import asyncio
 import pickle
-from operator import iadd, isub
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
 
 import pandas as pd
 import numpy as np
-from sqlalchemy import create_engine, text
 
-class Character:
-    def __init__(self, game_class, race):
-        self.item_class_map = {'consumable': 0, 'container': 1, 'weapon': 2, 'armor': 4, 'reagent': 5, 
-                               'projectile': 6, 'trade good': 7, 'recipe': 9, 'quiver': 11, 'quest': 12, 
-                               'key': 13, 'miscellaneous': 15}
+from db import get_engine, read_sql, read_sql_async
+from catalog import get_catalog, get_catalog_async, BONUS_STATS, BONUS_ATTR_NAME, RESIST_TYPE, DELTA_ATTRS
+from evaluation import BATCH_STATS, DERIVED_ATTRS, class_coefficients, derived_stats, stat_matrix
 
-        self.item_subclass_map = {'cloth': 1, 'leather': 2, 'mail': 3, 'plate': 4}
+ITEM_CLASS_MAP = {'consumable': 0, 'container': 1, 'weapon': 2, 'armor': 4, 'reagent': 5, 
+                  'projectile': 6, 'trade good': 7, 'recipe': 9, 'quiver': 11, 'quest': 12, 
+                  'key': 13, 'miscellaneous': 15}
 
-        self.item_quality_map = {'poor': 0, 'common': 1, 'uncommon': 2, 
-                                 'rare': 3, 'epic': 4, 'legendary': 5}
+ITEM_SUBCLASS_MAP = {'cloth': 1, 'leather': 2, 'mail': 3, 'plate': 4}
 
-        self.item_type_map = {'head': [1], 'neck': [2], 'shoulders': [3], 'chest': [4, 5, 20], 
-                              'waist': [6], 'legs': [7], 'feet': [8], 'wrists': [9], 
-                              'hands': [10], 'finger1': [11], 'finger2': [11], 'trinket1': [12], 
-                              'trinket2': [12], 'one-hand': [13, 21], 'shield': [14], 'ranged': [15], 
-                              'back': [16], 'two_hand': [17], 'offhand': [22], 'thrown': [25], 
-                              'gun': [26], 'bow': [15], 'left-hand': [22], 'relic': [28]}
+ITEM_QUALITY_MAP = {'poor': 0, 'common': 1, 'uncommon': 2, 
+                    'rare': 3, 'epic': 4, 'legendary': 5}
 
-        self.stat_reverse_map = {1: 'health', 3: 'agility', 4: 'strenght', 
-                                 5: 'intellect', 6: 'spirit', 7: 'stamina'}
+ITEM_TYPE_MAP = {'head': [1], 'neck': [2], 'shoulders': [3], 'chest': [4, 5, 20], 
+                 'waist': [6], 'legs': [7], 'feet': [8], 'wrists': [9], 
+                 'hands': [10], 'finger1': [11], 'finger2': [11], 'trinket1': [12], 
+                 'trinket2': [12], 'one-hand': [13, 21], 'shield': [14], 'ranged': [15], 
+                 'back': [16], 'two_hand': [17], 'offhand': [22], 'thrown': [25], 
+                 'gun': [26], 'bow': [15], 'left-hand': [22], 'relic': [28]}
 
-        self.stat_map = {'health': 1, 'agility': 3, 'strenght': 4, 
-                         'intellect': 5, 'spirit': 6, 'stamina': 7}
+STAT_REVERSE_MAP = {1: 'health', 3: 'agility', 4: 'strenght', 
+                    5: 'intellect', 6: 'spirit', 7: 'stamina'}
 
-        self.spell_map = {'on use': 0, 'on equip': 1, 'chance on hit': 2, 
-                          'soulstone': 4, 'on use without delay': 5}
+STAT_MAP = {'health': 1, 'agility': 3, 'strenght': 4, 
+            'intellect': 5, 'spirit': 6, 'stamina': 7}
 
-        self.bounding_map = {'no binding': 0, 'bind on pickup': 1, 'bind on equip': 2, 
-                             'bind on use': 3 ,'quest item': 4}
-        
-        self.bounding_reverse_map = {0: 'no binding', 1: 'bind on pickup', 2: 'bind on equip', 
-                                     3: 'bind on use', 4: 'quest item'}
+SPELL_MAP = {'on use': 0, 'on equip': 1, 'chance on hit': 2, 
+             'soulstone': 4, 'on use without delay': 5}
 
-        self.damage_map = {'physical': 0, 'holy': 1, 'fire': 2, 'nature': 3, 
-                           'frost': 4, 'shadow': 5, 'arcane': 6}
-        
-        self.damage_reverse_map = {0: 'physical', 1: 'holy', 2: 'fire', 3: 'nature', 
-                                   4: 'frost', 5: 'shadow', 6: 'arcane'}
-        
-        self.race_map = {'human': 1, 'orc': 2, 'dwarf': 3, 'elf': 4, 
-                         'undead': 5, 'tauren': 6, 'gnome': 7, 'troll': 8}
+BOUNDING_MAP = {'no binding': 0, 'bind on pickup': 1, 'bind on equip': 2, 
+                'bind on use': 3 ,'quest item': 4}
 
-        self.class_map = {'warrior': 1, 'paladin': 2, 'hunter': 3, 'rogue': 4, 'prist': 5, 
-                          'shaman': 7, 'mage': 8, 'warlock': 9, 'druid': 11}
-        
-        # order is matter add_remove_stats method
-        self.bonus_stats = ('Increase Spell Dam', 'Increase Fire Dam', 'Increase Shadow Dam', 
-                            'Increase Nature Dam', 'Increase Frost Dam', 'Increase Holy Dam', 
-                            'Increase Arcane Dam', 'Increase Healing', 'Increased Critical', 
-                            'Increased Critical Spell', 'Increased Mana Regen', 'Increased Defense', 
-                            'Increased Dodge', 'Increased Parry', 'Attack Power', 'Increased Hit Chance')
-        
-        self.bonus_attr_name = ('spell_power', 'spell_fire_power', 'spell_shadow_power', 
-                                'spell_nature_power', 'spell_frost_power', 'spell_holy_power', 
-                                'spell_arcane_power', 'healing_power', 'base_crit', 
-                                'base_spell_crit', 'mana_reg_bonus', 'defence',
-                                'base_dodge', 'parry', 'base_attack_power', 'hit_chance')
-        
-        self.resist_type = ('holy_res', 'fire_res', 'nature_res', 
-                            'frost_res', 'shadow_res', 'arcane_res')
-        
+BOUNDING_REVERSE_MAP = {0: 'no binding', 1: 'bind on pickup', 2: 'bind on equip', 
+                        3: 'bind on use', 4: 'quest item'}
+
+DAMAGE_MAP = {'physical': 0, 'holy': 1, 'fire': 2, 'nature': 3, 
+              'frost': 4, 'shadow': 5, 'arcane': 6}
+
+DAMAGE_REVERSE_MAP = {0: 'physical', 1: 'holy', 2: 'fire', 3: 'nature', 
+                      4: 'frost', 5: 'shadow', 6: 'arcane'}
+
+RACE_MAP = {'human': 1, 'orc': 2, 'dwarf': 3, 'elf': 4, 
+            'undead': 5, 'tauren': 6, 'gnome': 7, 'troll': 8}
+
+CLASS_MAP = {'warrior': 1, 'paladin': 2, 'hunter': 3, 'rogue': 4, 'prist': 5, 
+             'shaman': 7, 'mage': 8, 'warlock': 9, 'druid': 11}
+
+CLASS_REVERSE_MAP = {value: key for key, value in CLASS_MAP.items()}
+
+RACE_REVERSE_MAP = {value: key for key, value in RACE_MAP.items()}
+
+# binary format of Character.save: header, base stats, filled slots, stats
+SAVE_MAGIC = b'WCHR'
+SAVE_VERSION = 1
+# magic, version, class, race, number of filled slots, number of stats
+SAVE_HEADER = struct.Struct('<4sBBBBB')
+# basehp, basemana and BASE_STAT_COLUMNS
+SAVE_BASE = struct.Struct('<7d')
+# index of slot in SLOTS, item id
+SAVE_SLOT = struct.Struct('<Bi')
+
+BASE_STAT_COLUMNS = ('str', 'agi', 'sta', 'inte', 'spi')
+
+# order of slots in CharacterState.gear
+SLOTS = tuple(ITEM_TYPE_MAP)
+SLOT_INDEX = {slot: i for i, slot in enumerate(SLOTS)}
+
+# slot of an item by its InventoryType, first matching slot is used
+INVENTORY_SLOT = {item_type: slot for slot, types in reversed(list(ITEM_TYPE_MAP.items())) 
+                  for item_type in types}
+
+# column groups of catalog human_readable_df needs, spells come from parsed bonuses
+READABLE_GROUPS = ('core', 'stats', 'resistances', 'weapon')
+
+# equipped slots freed when an item is put in a slot
+SLOT_CONFLICTS = {'one-hand': ('two_hand',), 
+                  'left-hand': ('two_hand', 'offhand', 'shield'), 
+                  'offhand': ('two_hand', 'left-hand', 'shield'), 
+                  'shield': ('two_hand', 'left-hand', 'offhand'), 
+                  'ranged': ('bow', 'gun'), 'bow': ('ranged', 'gun'), 'gun': ('ranged', 'bow'), 
+                  'two_hand': ('one-hand', 'left-hand', 'offhand', 'shield')}
+
+
+def equip_slot(items_on, slot):
+    'Slot an item of given slot goes to and equipped slots it frees, rules of Character.wear_item'
+    # if one ring or trinket is equipped check another one
+    for first, second in (('finger1', 'finger2'), ('trinket1', 'trinket2')):
+        if (slot == first) and (items_on[slot] is not None) and (items_on[second] is None):
+            slot = second
+        elif (slot == second) and (items_on[slot] is not None) and (items_on[first] is None):
+            slot = first
+    
+    # sanity check for weapons
+    freed = [other for other in SLOT_CONFLICTS.get(slot, ()) if items_on[other] is not None]
+    
+    # old item
+    if items_on[slot] is not None:
+        freed.append(slot)
+    
+    return slot, freed
+
+
+@lru_cache(maxsize=None)
+def class_race_tables(game_class, race):
+    'Multipliers shared by all characters of class and race'
+    coefficients = class_coefficients(game_class, race)
+    
+    # derived stats changed by every attribute in catalog.DELTA_ATTRS
+    matrix = stat_matrix(coefficients)
+    dependents = tuple(frozenset(attr for key, attr in DERIVED_ATTRS.items() 
+                                 if matrix[i, BATCH_STATS.index(key)] != 0)
+                       for i in range(len(DELTA_ATTRS)))
+    
+    # racial bonuses to intellect and spirit from items
+    delta_scale = np.ones(len(DELTA_ATTRS))
+    if race == 'gnome':
+        delta_scale[DELTA_ATTRS.index('inte')] = 1.05
+    if race == 'human':
+        delta_scale[DELTA_ATTRS.index('spi')] = 1.05
+    delta_scale.flags.writeable = False
+    
+    return coefficients, dependents, delta_scale
+
+
+# base hp/mana and base stats of every class and race, shared by all instances
+_base_tables = {}
+
+BASE_HP_MANA_CLASS_QUERY = """
+SELECT *
+FROM player_classlevelstats
+WHERE level = 60 and class = :cls;
+"""
+
+BASE_STATS_CLASS_QUERY = """
+SELECT *
+FROM player_levelstats
+WHERE level = 60 and class = :cls and race = :race;
+"""
+
+
+class Character:
+    # static tables are shared by all instances
+    item_class_map = ITEM_CLASS_MAP
+    item_subclass_map = ITEM_SUBCLASS_MAP
+    item_quality_map = ITEM_QUALITY_MAP
+    item_type_map = ITEM_TYPE_MAP
+    stat_reverse_map = STAT_REVERSE_MAP
+    stat_map = STAT_MAP
+    spell_map = SPELL_MAP
+    bounding_map = BOUNDING_MAP
+    bounding_reverse_map = BOUNDING_REVERSE_MAP
+    damage_map = DAMAGE_MAP
+    damage_reverse_map = DAMAGE_REVERSE_MAP
+    race_map = RACE_MAP
+    class_map = CLASS_MAP
+    inventory_slot = INVENTORY_SLOT
+    
+    # order is matter, see catalog.parse_bonus
+    bonus_stats = BONUS_STATS
+    bonus_attr_name = BONUS_ATTR_NAME
+    resist_type = RESIST_TYPE
+    
+    def __init__(self, game_class, race):
         self.game_class = self.valid_key(game_class, self.class_map)
         self.race = self.valid_key(race, self.race_map)
         
-        self.engine = self.connect()
-        self.items = pd.read_sql_query(""" 
-        SELECT 
-          entry AS id, name, AllowableClass, InventoryType, subclass, Quality, bonding, 
-          armor, holy_res, fire_res, nature_res, frost_res, shadow_res, arcane_res,
-          stat_type1, stat_value1, 
-          stat_type2, stat_value2, 
-          stat_type3, stat_value3, 
-          stat_type4, stat_value4,
-          stat_type5, stat_value5,
-          dmg_min1, dmg_max1, dmg_type1,
-          dmg_min2, dmg_max2, dmg_type2,
-          dmg_min3, dmg_max3, dmg_type3,
-          delay,
-          spelltrigger_1, s1.SpellName AS sp1, s1.EffectBasePoints1 AS spb1, 
-          spelltrigger_2, s2.SpellName AS sp2, s2.EffectBasePoints1 AS spb2, 
-          spelltrigger_3, s3.SpellName AS sp3, s3.EffectBasePoints1 AS spb3
-        FROM item_template
-          LEFT JOIN spell_template as s1 ON spellid_1 = s1.Id
-          LEFT JOIN spell_template as s2 ON spellid_2 = s2.Id
-          LEFT JOIN spell_template as s3 ON spellid_3 = s3.Id
-        """, self.engine)
-        
-        self.base_hp_mana = pd.read_sql_query("""
-        SELECT *
-        FROM player_classlevelstats
-        WHERE level = 60 and class = %(cls)s;
-        """, self.engine, params={'cls': self.class_map[self.game_class]})
-        
-        self.base_stats = pd.read_sql_query("""
-        SELECT *
-        FROM player_levelstats
-        WHERE level = 60 and class = %(cls)s and race = %(race)s;
-        """, self.engine, params={'cls': self.class_map[self.game_class], 
-                                  'race': self.race_map[self.race]})
+        # shared between all instances, queried only once per process
+        self.catalog = get_catalog(self.connect)
+        # catalog.generation stats of worn items were taken from, see refresh_stats
+        self.generation = self.catalog.generation
+        
+        self.base_hp_mana, self.base_stats = self.load_base_tables()
         
         # main stats
         self.sta = self.base_stats['sta'].values[0]
@@ -178,11 +251,46 @@ class Character:
         self.spell_frost_power = 0
         self.spell_arcane_power = 0
         
+        # class and race multipliers as plain floats
+        self.base_hp = float(self.base_hp_mana['basehp'].values[0])
+        self.base_mana = float(self.base_hp_mana['basemana'].values[0])
+        self.coefficients, self.dependents, self.delta_scale = class_race_tables(self.game_class, self.race)
+        
         self.calculate_stats()
         
+        # values of character without any item, starting point of evaluation.evaluate_gear
+        self.naked = self.stat_vector()
+        
         self.items_on = {item: None for item in self.item_type_map}
         
-    def valid_key(self, key, mapper):
+        # sum of deltas of worn items without racial bonuses, see update_stats
+        self.worn_deltas = np.zeros(len(DELTA_ATTRS))
+        
+    @property
+    def items(self):
+        # rows of catalog can be replaced by catalog.update_catalog
+        return self.catalog.items
+    
+    def load_base_tables(self):
+        'Base hp/mana and base stats of class and race, queried once per process'
+        key = (self.game_class, self.race)
+        if key in _base_tables:
+            return _base_tables[key]
+        
+        if self.catalog.has_base_stats():
+            # catalog from snapshot already has base stats, no database is needed
+            tables = self.catalog.base_tables(self.class_map[self.game_class], self.race_map[self.race])
+        else:
+            self.engine = self.connect()
+            params = {'cls': self.class_map[self.game_class], 'race': self.race_map[self.race]}
+            tables = (read_sql(BASE_HP_MANA_CLASS_QUERY, self.engine, params),
+                      read_sql(BASE_STATS_CLASS_QUERY, self.engine, params))
+        
+        _base_tables[key] = tables
+        return tables
+    
+    @staticmethod
+    def valid_key(key, mapper):
         # check if key is valid
         if key in mapper:
             return key
@@ -190,252 +298,159 @@ class Character:
             print('Valid keys are: ', mapper.keys())
             raise KeyError('Invalid key: {}'.format(key))
     
-    def calculate_stats(self):
-        if self.race == 'tauren':
-            self.hp = self.base_hp_mana['basehp'].values[0] + self.sta * 10.5 + self.bonus_hp
-        else:
-            self.hp = self.base_hp_mana['basehp'].values[0] + self.sta * 10 + self.bonus_hp
-        self.mana = self.base_hp_mana['basemana'].values[0] + self.inte * 15
-        self.armor = self.agi * 2 + self.base_armor
-        
-        # melee attack power from strenght 
-        if self.game_class in ['hunter', 'mage', 'prist', 'rogue', 'warlock']:
-            self.melee_attack_power = self.base_attack_power + self.str
-        else:
-            self.melee_attack_power = self.base_attack_power + self.str * 2
+    def to_state(self):
+        'Compact copy of the character, see CharacterState'
+        template = _templates.get((self.game_class, self.race))
+        if template is None or template.catalog is not self.catalog:
+            _templates[(self.game_class, self.race)] = self.naked_copy()
+        gear = np.array([self.items_on[slot] or 0 for slot in SLOTS], dtype=np.int32)
+        return CharacterState(self.game_class, self.race, self.stat_vector(), gear)
+    
+    def naked_copy(self):
+        'Copy of the character without any item, no database query is needed'
+        character = copy.copy(self)
+        character.items_on = {item: None for item in self.item_type_map}
+        character.set_stats(self.naked)
+        character.worn_deltas = np.zeros(len(DELTA_ATTRS))
+        return character
+    
+    def gear_deltas(self, items_on):
+        'Sum of deltas of items_on without racial bonuses'
+        positions = [self.catalog.position(ids) for ids in items_on.values() if ids is not None]
+        return self.catalog.deltas[positions].sum(axis=0) if positions else np.zeros(len(DELTA_ATTRS))
+    
+    def gear_stats(self, items_on):
+        '''
+        DELTA_ATTRS values of the character wearing items_on. Item deltas are whole
+        numbers, so their sum and the result do not depend on order items were worn in.
+        '''
+        # racial bonuses apply to items only
+        return self.naked + self.gear_deltas(items_on) * self.delta_scale
+    
+    def set_stats(self, stats):
+        'Set DELTA_ATTRS values and calculate derived stats from them'
+        for stat, value in zip(DELTA_ATTRS, np.asarray(stats, dtype=float)):
+            self.__setattr__(stat, value)
+        self.calculate_stats()
+        # not known until the next change, see update_stats
+        self.worn_deltas = None
+    
+    def refresh_stats(self):
+        '''
+        Stats from current catalog rows of items worn, called when update_catalog
+        replaced rows since the last change. Items no longer in catalog are taken off.
+        '''
+        for slot, ids in self.items_on.items():
+            if ids is not None and ids not in self.catalog.index:
+                self.items_on[slot] = None
+        self.set_stats(self.gear_stats(self.items_on))
+        self.worn_deltas = self.gear_deltas(self.items_on)
+        self.generation = self.catalog.generation
+    
+    def stat_vector(self):
+        'Current values of attributes changed by items, ordered as catalog.DELTA_ATTRS'
+        if self.generation != self.catalog.generation:
+            self.refresh_stats()
+        return np.array([self.__getattribute__(stat) for stat in DELTA_ATTRS], dtype=float)
+    
+    def calculate_stats(self, derived=None):
+        '''
+        Derived stats from current attributes, only names in derived if it is given,
+        e.g. the dependents of attributes changed by update_stats.
+        '''
+        c = self.coefficients
+        if derived is None or 'hp' in derived:
+            self.hp = self.base_hp + self.sta * c['hp_per_sta'] + self.bonus_hp
+        if derived is None or 'mana' in derived:
+            self.mana = self.base_mana + self.inte * c['mana_per_inte']
+        if derived is None or 'armor' in derived:
+            self.armor = self.agi * c['armor_per_agi'] + self.base_armor
+        
+        # attack power from strenght and agility
+        if derived is None or 'melee_attack_power' in derived:
+            self.melee_attack_power = (self.base_attack_power + self.str * c['melee_ap_per_str'] + 
+                                       self.agi * c['melee_ap_per_agi'])
+        if derived is None or 'range_attack_power' in derived:
+            self.range_attack_power = self.base_attack_power * c['range_ap'] + self.agi * c['range_ap_per_agi']
+        
+        # crit from agility, spell crit from intellect
+        if derived is None or 'crit' in derived:
+            self.crit = self.base_crit + self.agi * c['crit_per_agi']
+        if derived is None or 'spell_crit' in derived:
+            self.spell_crit = self.base_spell_crit + self.inte * c['spell_crit_per_inte']
         
-        # range attack power from agility 
-        if self.game_class in ['rogue', 'warrior']:
-            self.range_attack_power = self.base_attack_power + self.agi
-        elif self.game_class == 'hunter':
-            self.range_attack_power = self.base_attack_power + self.agi * 2
-            
-        # melee attack power from agility 
-        if self.game_class in ['rogue', 'druid', 'hunter']:
-            self.melee_attack_power += self.agi
-            
-        # crit from agility
-        if self.game_class in ['druid', 'paladin', 'shaman', 'warrior']:
-            self.crit = self.base_crit + self.agi / 20
-        elif self.game_class == 'rogue':
-            self.crit = self.base_crit + self.agi / 29            
-        elif self.game_class == 'hunter':
-            self.crit = self.base_crit + self.agi / 53 
-        else: 
-            self.crit = self.base_crit
-            
-        # spell crit from intellect
-        if self.game_class == 'paladin':
-            self.spell_crit = self.base_spell_crit + self.inte / 54
-        else:
-            self.spell_crit = self.base_spell_crit + self.inte / 60
-            
         # mana reg
-        if self.game_class in ['druid', 'paladin', 'warlock', 'hunter', 'shaman']:
-            self.mana_reg = self.mana_reg_bonus + self.spi / 5
-        elif self.game_class in ['mage', 'prist']:
-            self.mana_reg = self.mana_reg_bonus + self.spi / 4
+        if derived is None or 'mana_reg' in derived:
+            self.mana_reg = (self.mana_reg_bonus + self.spi * c['mana_reg_per_spi']) * c['mana_reg']
         
         # dodge from agility
-        if self.game_class == 'rogue':
-            self.dodge = self.base_dodge + self.agi / 14.5            
-        elif self.game_class == 'hunter':
-            self.dodge = self.base_dodge + self.agi / 26
-        else:
-            self.dodge = self.base_dodge + self.agi / 20     
-        
+        if derived is None or 'dodge' in derived:
+            self.dodge = self.base_dodge + self.agi * c['dodge_per_agi']
             
     def wear_item(self, ids):
-        # check if item with such id exist
-        temp = self.items.loc[self.items['id'] == ids]
-        if temp.shape[0] == 0:
-            raise KeyError('No item with such id.')
+        if self.generation != self.catalog.generation:
+            self.refresh_stats()
         
-        item_type = temp['InventoryType'].values[0]
-        for key, value in self.item_type_map.items():
-            if item_type in value:
-                slot = key
-                break
+        # check if item with such id exist
+        position = self.catalog.position(ids)
         
-        # if one ring is equipped check another one
-        if (slot == 'finger1') and (self.items_on[slot] is not None) and (self.items_on['finger2'] is None):
-            slot = 'finger2'
-        elif (slot == 'finger2') and (self.items_on[slot] is not None) and (self.items_on['finger1'] is None):
-            slot = 'finger1'
-
-        # if one trinket is equipped check another one
-        if (slot == 'trinket1') and (self.items_on[slot] is not None) and (self.items_on['trinket2'] is None):
-            slot = 'trinket2'
-        elif (slot == 'trinket2') and (self.items_on[slot] is not None) and (self.items_on['trinket1'] is None):
-            slot = 'trinket1'
+        slot, freed = equip_slot(self.items_on, self.inventory_slot[self.catalog.inventory_type[position]])
         
         # check if character can wear it
-        if (temp['AllowableClass'].values[0] == -1) or \
-        (temp['AllowableClass'].values[0] == self.class_map[self.game_class]):
+        if (self.catalog.allowable_class[position] == -1) or \
+        (self.catalog.allowable_class[position] == self.class_map[self.game_class]):
             pass
         else:
             raise KeyError('Can\'t be used by your class.')
         
-        # sanity check for weapons 
-        if (slot == 'one-hand') or (slot == 'left-hand') or (slot == 'offhand') or (slot == 'shield'):
-            # if try to use one-hand weapon remove two-hand one
-            if self.items_on['two_hand'] is not None:
-                self.add_remove_stats('sub', self.items.loc[self.items['id'] == self.items_on['two_hand']])
-                self.items_on['two_hand'] = None
-                
-            if slot == 'left-hand':
-                if self.items_on['offhand'] is not None:
-                    self.add_remove_stats('sub', self.items.loc[self.items['id'] == self.items_on['offhand']])
-                    self.items_on['offhand'] = None 
-
-                if self.items_on['shield'] is not None:
-                    self.add_remove_stats('sub', self.items.loc[self.items['id'] == self.items_on['shield']])
-                    self.items_on['shield'] = None 
-                    
-            elif slot == 'offhand':
-                if self.items_on['left-hand'] is not None:
-                    self.add_remove_stats('sub', self.items.loc[self.items['id'] == self.items_on['left-hand']])
-                    self.items_on['left-hand'] = None 
-
-                if self.items_on['shield'] is not None:
-                    self.add_remove_stats('sub', self.items.loc[self.items['id'] == self.items_on['shield']])
-                    self.items_on['shield'] = None                    
-                    
-            elif slot == 'shield':
-                if self.items_on['left-hand'] is not None:
-                    self.add_remove_stats('sub', self.items.loc[self.items['id'] == self.items_on['left-hand']])
-                    self.items_on['left-hand'] = None 
-
-                if self.items_on['offhand'] is not None:
-                    self.add_remove_stats('sub', self.items.loc[self.items['id'] == self.items_on['offhand']])
-                    self.items_on['offhand'] = None    
-                    
-        if (slot == 'ranged') or (slot == 'bow') or (slot == 'gun'):
-            if slot == 'ranged':
-                if self.items_on['bow'] is not None:
-                    self.add_remove_stats('sub', self.items.loc[self.items['id'] == self.items_on['bow']])
-                    self.items_on['bow'] = None 
-
-                if self.items_on['gun'] is not None:
-                    self.add_remove_stats('sub', self.items.loc[self.items['id'] == self.items_on['gun']])
-                    self.items_on['gun'] = None 
-                    
-            elif slot == 'bow':
-                if self.items_on['ranged'] is not None:
-                    self.add_remove_stats('sub', self.items.loc[self.items['id'] == self.items_on['ranged']])
-                    self.items_on['ranged'] = None 
-
-                if self.items_on['gun'] is not None:
-                    self.add_remove_stats('sub', self.items.loc[self.items['id'] == self.items_on['gun']])
-                    self.items_on['gun'] = None                    
-                    
-            elif slot == 'gun':
-                if self.items_on['ranged'] is not None:
-                    self.add_remove_stats('sub', self.items.loc[self.items['id'] == self.items_on['ranged']])
-                    self.items_on['ranged'] = None 
-
-                if self.items_on['bow'] is not None:
-                    self.add_remove_stats('sub', self.items.loc[self.items['id'] == self.items_on['bow']])
-                    self.items_on['bow'] = None    
-            
-        # if try to use two-hand weapon remove all one-hand ones
-        elif slot == 'two_hand':
-            if self.items_on['one-hand'] is not None:
-                self.add_remove_stats('sub', self.items.loc[self.items['id'] == self.items_on['one-hand']])
-                self.items_on['one-hand'] = None
-                
-            elif self.items_on['left-hand'] is not None:
-                self.add_remove_stats('sub', self.items.loc[self.items['id'] == self.items_on['left-hand']])
-                self.items_on['left-hand'] = None
-                
-            elif self.items_on['offhand'] is not None:
-                self.add_remove_stats('sub', self.items.loc[self.items['id'] == self.items_on['offhand']])
-                self.items_on['offhand'] = None 
-                
-            elif self.items_on['shield'] is not None:
-                self.add_remove_stats('sub', self.items.loc[self.items['id'] == self.items_on['shield']])
-                self.items_on['shield'] = None 
-                
-        # remove old item
-        if self.items_on[slot] is not None:
-            self.add_remove_stats('sub', self.items.loc[self.items['id'] == self.items_on[slot]])
-            self.items_on[slot] = None
-        
-        # add stats from new item
-        self.add_remove_stats('add', temp)
+        # remove conflicting weapons and old item
+        change = self.catalog.deltas[position].copy()
+        for other in freed:
+            change -= self.catalog.deltas[self.catalog.position(self.items_on[other])]
+            self.items_on[other] = None
         
         # update dict
         self.items_on[slot] = ids
-    
-    def add_remove_stats(self, operation, temp):
-        if operation == 'sub':
-            operator = isub
-        elif operation == 'add':
-            operator = iadd
-            
-        # main stats
-        for i in range(1, 6):
-            stat_type = temp['stat_type{}'.format(i)].values[0]
-            value = temp['stat_value{}'.format(i)].values[0]
-            if stat_type == 1:
-                self.bonus_hp = operator(self.bonus_hp, value)
-            elif stat_type == 3:
-                self.agi = operator(self.agi, value)
-            elif stat_type == 4:
-                self.str = operator(self.str, value)
-            elif stat_type == 5:
-                if self.race == 'gnome':
-                    self.inte = operator(self.inte, value * 1.05)
-                else:
-                    self.inte = operator(self.inte, value)
-            elif stat_type == 6:
-                if self.race == 'human':
-                    self.spi = operator(self.spi, value * 1.05)
-                else:
-                    self.spi = operator(self.spi, value)
-            elif stat_type == 7:
-                self.sta = operator(self.sta, value)  
-                
-        # armor
-        self.base_armor = operator(self.base_armor, temp['armor'].values[0])
         
-        # resist
-        for resist_type in self.resist_type:
-            value = temp[resist_type].values[0]
-            self.__setattr__(resist_type, value if operation == 'add' else -value)
-        
-        # green bonuses
-        for i in range(1, 4):
-            bonus_type = temp['sp{}'.format(i)].values[0]
-            value = temp['spb{}'.format(i)].values[0]
-            # if None no need to check stats in other columns
-            if bonus_type is None:
-                    continue
-            for bonus, stat in zip(self.bonus_stats, self.bonus_attr_name):
-                # check if  within available bonuses
-                if re.search('{}( \d+)?$'.format(bonus), bonus_type):
-                    # if bonus has it value in the end of string
-                    if re.search('{}( \d+)?$'.format(bonus), bonus_type).group(1):
-                        value = int(re.search('{}( \d+)?$'.format(bonus), bonus_type).group(1).strip())
-                    prev_value = self.__getattribute__(stat)
-                    self.__setattr__(stat, prev_value + value if operation == 'add' 
-                                     else prev_value - value)
-                    break
-        
-        # recalculate stats
-        self.calculate_stats()
+        self.update_stats(change)
+    
+    def update_stats(self, change):
+        '''
+        Add change of the sum of worn item deltas, only attributes it changes and
+        derived stats that depend on them are updated. The sum is kept without racial
+        bonuses, item deltas are whole numbers, so it is exact and stats never drift.
+        '''
+        if self.worn_deltas is None:
+            # stats were set from outside, e.g. from a saved character, take them from items worn
+            self.set_stats(self.gear_stats(self.items_on))
+            self.worn_deltas = self.gear_deltas(self.items_on)
+            return
+        
+        self.worn_deltas = self.worn_deltas + change
+        changed = change.nonzero()[0]
+        # racial bonuses apply to items only, the same values as gear_stats
+        values = self.naked[changed] + self.worn_deltas[changed] * self.delta_scale[changed]
+        derived = set()
+        for i, value in zip(changed, values):
+            self.__setattr__(DELTA_ATTRS[i], value)
+            derived |= self.dependents[i]
+        self.calculate_stats(derived)
     
     def remove_item(self, slot):
+        if self.generation != self.catalog.generation:
+            self.refresh_stats()
         slot = self.valid_key(slot, self.item_type_map)
-        # old item to remove
-        temp = self.items.loc[self.items['id'] == self.items_on[slot]]
+        if self.items_on[slot] is None:
+            raise KeyError('No item with such id.')
         
-        # update stats
-        self.add_remove_stats('sub', temp)
+        change = -self.catalog.deltas[self.catalog.position(self.items_on[slot])]
         
         # update dict
         self.items_on[slot] = None
         
+        # update stats
+        self.update_stats(change)
+        
     def show_empty_slots(self):
         empty = []
         
@@ -446,6 +461,8 @@ class Character:
         return empty
 
     def summary(self, hide_resist=False):
+        if self.generation != self.catalog.generation:
+            self.refresh_stats()
         orddict = OrderedDict()
         
         for key, value in zip(['hp', 'mana', 'mana_reg', 'stamina', 'strength', 'intellect', 'agility',
@@ -454,7 +471,7 @@ class Character:
                                'dodge', 'parry', 'defence'],
                               [self.hp, self.mana, self.mana_reg, self.sta, self.str, self.inte, self.agi,
                                self.spi, self.armor, self.physical_damage_reduction(), self.melee_attack_power, 
-                               self.range_attack_power, self.spell_power, self.spell_holy_power, self.crit, 
+                               self.range_attack_power, self.spell_power, self.healing_power, self.crit, 
                                self.spell_crit, self.hit_chance, self.dodge, self.parry, self.defence]):
             if key == 'physical_reduction':    
                 orddict[key] = round(value, 3)
@@ -469,6 +486,63 @@ class Character:
         
         return orddict
 
+    def gear_change(self, changes):
+        '''
+        Change of DELTA_ATTRS values and items_on after changes ({slot: item id or None}),
+        character is not changed. Item goes to the given slot and frees conflicting
+        ones as in wear_item, None empties the slot. Changes are applied in order.
+        '''
+        items_on = dict(self.items_on)
+        delta = np.zeros(len(DELTA_ATTRS))
+        for slot, ids in changes.items():
+            slot = self.valid_key(slot, self.item_type_map)
+            freed = [slot]
+            if ids is not None:
+                position = self.catalog.position(ids)
+                if self.catalog.inventory_type[position] not in self.item_type_map[slot]:
+                    raise KeyError('Item {} can\'t be worn in {}.'.format(ids, slot))
+                if self.catalog.allowable_class[position] not in (-1, self.class_map[self.game_class]):
+                    raise KeyError('Can\'t be used by your class.')
+                freed.extend(SLOT_CONFLICTS.get(slot, ()))
+
+            for other in freed:
+                if items_on[other] is not None:
+                    delta -= self.catalog.deltas[self.catalog.position(items_on[other])]
+                    items_on[other] = None
+
+            if ids is not None:
+                delta += self.catalog.deltas[position]
+                items_on[slot] = ids
+
+        # racial bonuses apply to items only
+        return delta * self.delta_scale, items_on
+
+    def what_if(self, changes, hide_resist=False):
+        '''
+        Change of summary() if changes ({slot: item id or None}) were made,
+        e.g. {'two_hand': 19019, 'head': None}. See gear_change for the rules.
+        '''
+        frame = self.what_if_batch([changes], hide_resist)
+        return OrderedDict(zip(frame.columns, frame.iloc[0].tolist()))
+
+    def what_if_batch(self, changes, hide_resist=False):
+        '''
+        what_if of every change set in the list changes at once, returns frame
+        with a row of summary() changes per set. Character is not changed, so
+        it is safe to call from many threads.
+        '''
+        current = self.stat_vector()
+        # stats of gear after changes are summed as wear_item does, so they match it exactly
+        stats = np.array([self.gear_stats(self.gear_change(change)[1]) for change in changes]).reshape(-1, len(DELTA_ATTRS))
+        coefficients = (self.base_hp, self.base_mana, self.coefficients)
+        delta = derived_stats(stats, *coefficients) - derived_stats(current, *coefficients)
+
+        frame = pd.DataFrame(delta, columns=list(BATCH_STATS))
+        # same columns and rounding as summary
+        if not hide_resist:
+            frame = frame.drop(columns=list(RESIST_TYPE))
+        return frame.round({key: 3 if key == 'physical_reduction' else 1 for key in frame.columns})
+
     def physical_damage_reduction(self, attacker_level=60):
         return self.armor / (self.armor + (467.5 * attacker_level - 22167.5))        
 
@@ -482,62 +556,93 @@ class Character:
         return (resist / (5 * caster_level)) * 0.75
     
     def human_readable_df(self, df):
-        temp = df.copy()
-        columns = df.columns.to_list()
-        start_stat = columns.index('stat_type1')
-        bonus_stat = columns.index('spelltrigger_1')
-        
-        temp = temp.drop(['stat_type1', 'stat_value1', 'stat_type2', 'stat_value2', 'stat_type3', 
-                          'stat_value3', 'stat_type4', 'stat_value4', 'stat_type5', 'stat_value5',
-                          'dmg_min2', 'dmg_max2', 'dmg_type2', 'dmg_min3', 'dmg_max3', 'dmg_type3', 
-                          'spelltrigger_1', 'sp1', 'spb1', 'spelltrigger_2', 'sp2', 'spb2', 
-                          'spelltrigger_3', 'sp3', 'spb3', 
-                          'AllowableClass', 'InventoryType', 'subclass', 'Quality'], axis=1)
-        
-        for col in ('stamina', 'strenght', 'intellect', 'agility', 'spirit', 'health') + self.bonus_stats:
-            temp.loc[:, col] = 0   
+        temp = df.drop(['stat_type1', 'stat_value1', 'stat_type2', 'stat_value2', 'stat_type3', 
+                        'stat_value3', 'stat_type4', 'stat_value4', 'stat_type5', 'stat_value5',
+                        'dmg_min2', 'dmg_max2', 'dmg_type2', 'dmg_min3', 'dmg_max3', 'dmg_type3', 
+                        'spelltrigger_1', 'sp1', 'spb1', 'spelltrigger_2', 'sp2', 'spb2', 
+                        'spelltrigger_3', 'sp3', 'spb3', 
+                        'AllowableClass', 'InventoryType', 'subclass', 'Quality'], axis=1, errors='ignore')
             
         temp['delay'] = temp['delay'] / 1000
         temp['bonding'] = temp['bonding'].map(self.bounding_reverse_map)
         temp['dmg_type1'] = temp['dmg_type1'].map(self.damage_reverse_map)
         
-
-        for row in df.itertuples():
-            idx = row[1]
-            stat_row = row[start_stat + 1: start_stat + 10 + 1]
-            # main stat
-            for i in range(5):
-                if stat_row[2 * i] == 0:
-                    continue
-                temp.loc[temp['id'] == idx, self.stat_reverse_map[stat_row[2 * i]]] = stat_row[2 * i + 1]
-
-            bonus_row = row[bonus_stat + 1: bonus_stat + 9 + 1]
-            # bonus stat
-            for i in range(3):
-                if bonus_row[3 * i + 1] is None:
-                    continue
-                value = bonus_row[3 * i + 2]
-                for bonus in self.bonus_stats:
-                    # check if  within available bonuses
-                    if re.search('{}( \d+)?$'.format(bonus), bonus_row[3 * i + 1]):
-                        # if bonus has it value in the end of string
-                        if re.search('{}( \d+)?$'.format(bonus), bonus_row[3 * i + 1]).group(1):
-                            value = int(re.search('{}( \d+)?$'.format(bonus), 
-                                                  bonus_row[3 * i + 1]).group(1).strip())
-                        temp.loc[temp['id'] == idx, bonus] = value
-                        break
-
-        return temp
+        new_columns = OrderedDict((col, np.zeros(df.shape[0], dtype=np.int64)) for col in 
+                                  ('stamina', 'strenght', 'intellect', 'agility', 'spirit', 'health') + 
+                                  self.bonus_stats)
+        
+        # main stat, later pair of an item overwrites earlier one
+        for i in range(1, 6):
+            stat_type = df['stat_type{}'.format(i)].to_numpy()
+            stat_value = df['stat_value{}'.format(i)].to_numpy()
+            for key, col in self.stat_reverse_map.items():
+                rows = stat_type == key
+                new_columns[col][rows] = stat_value[rows]
+        
+        # bonus stat, later spell of an item overwrites earlier one
+        positions = self.catalog.positions(df['id'])
+        bonus_index = self.catalog.bonus_index[positions]
+        bonus_value = self.catalog.bonus_value[positions]
+        for i in range(3):
+            for j, col in enumerate(self.bonus_stats):
+                rows = bonus_index[:, i] == j
+                new_columns[col][rows] = bonus_value[rows, i]
+        
+        return pd.concat([temp, pd.DataFrame(new_columns, index=temp.index)], axis=1)
+    
+    def readable_items(self):
+        'Whole catalog in human readable form, built once and shared through catalog'
+        if self.catalog.readable is None:
+            self.catalog.readable = self.human_readable_df(self.catalog.columns(*READABLE_GROUPS))
+        return self.catalog.readable
     
     def search(self, slot, armor_type='', quality='epic', 
                orderby=['armor'], asc=False, 
-               hide_resist=False, hide_additional_spell_power=False):
-        slot = self.valid_key(slot, self.item_type_map)
-        quality = self.valid_key(quality, self.item_quality_map)
+               hide_resist=False, hide_additional_spell_power=False, limit=None, offset=0, store=None):
+        '''
+        Items for slot sorted by orderby. With limit only rows from offset to offset + limit
+        are selected without sorting the whole result, only they are made human readable.
+        With store (store.ItemStore) filters and sorting run in its database instead of catalog.
+        '''
+        if store is not None:
+            return store.search(self.game_class, slot, armor_type, quality, orderby, asc, 
+                                hide_resist, hide_additional_spell_power, limit, offset)
+        
+        positions = self.search_positions(slot, armor_type, quality, orderby)
+        
+        if limit is not None:
+            positions = self.top_positions(positions, orderby, asc, offset + limit)[offset:]
+            return self.hide_columns(self.readable_rows(positions), hide_resist, hide_additional_spell_power)
+        
+        if positions.shape[0] == 0:
+            return self.items.iloc[positions].copy()
+        
+        temp = self.readable_items().iloc[positions].sort_values(orderby, ascending=asc, kind='stable')
+        return self.hide_columns(temp, hide_resist, hide_additional_spell_power)
+    
+    def search_pages(self, slot, armor_type='', quality='epic', 
+                     orderby=['armor'], asc=False, 
+                     hide_resist=False, hide_additional_spell_power=False, page_size=50):
+        'Generator of search results, page_size rows each, every page is selected when asked'
+        positions = self.search_positions(slot, armor_type, quality, orderby)
+        for start in range(0, positions.shape[0], page_size):
+            page = self.top_positions(positions, orderby, asc, start + page_size)[start:]
+            yield self.hide_columns(self.readable_rows(page), hide_resist, hide_additional_spell_power)
+    
+    def search_positions(self, slot, armor_type, quality, orderby):
+        'Check search arguments and return catalog positions of items found'
+        return self.catalog.search_positions(*self.search_filters(self.game_class, slot, armor_type, 
+                                                                  quality, orderby))
+    
+    @staticmethod
+    def search_filters(game_class, slot, armor_type, quality, orderby):
+        'Check search arguments, return InventoryType values, class, quality and subclass (or None)'
+        slot = Character.valid_key(slot, ITEM_TYPE_MAP)
+        quality = Character.valid_key(quality, ITEM_QUALITY_MAP)
         for stat in orderby:
             if stat not in ('stamina', 'strenght', 'intellect', 'agility', 'spirit', 'health', 'armor') \
-            + self.bonus_stats:
-                print('Valid bonuses stats', self.bonus_stats)
+            + BONUS_STATS:
+                print('Valid bonuses stats', BONUS_STATS)
                 raise KeyError('Invalid bonus name: {}'.format(stat))
 
         # leave default value for slot that doesn't have armor_type
@@ -546,20 +651,58 @@ class Character:
             armor_type = ''
             
         if armor_type:
-            armor_type = self.valid_key(armor_type, self.item_subclass_map)
-        
-        temp = self.items.loc[((self.items['AllowableClass'] == -1) | \
-                               (self.items['AllowableClass'] == self.class_map[self.game_class])) & \
-                              (self.items['Quality'] == self.item_quality_map[quality]) & \
-                              (self.items['InventoryType'].isin(self.item_type_map[slot])) & \
-                              (self.items['subclass'] == self.item_subclass_map[armor_type] 
-                               if armor_type else True), :].copy()
-        
-        if temp.shape[0] == 0:
-            return temp
-        
-        temp = self.human_readable_df(temp).sort_values(orderby, ascending=asc)
+            armor_type = Character.valid_key(armor_type, ITEM_SUBCLASS_MAP)
         
+        return (ITEM_TYPE_MAP[slot], CLASS_MAP[game_class], ITEM_QUALITY_MAP[quality],
+                ITEM_SUBCLASS_MAP[armor_type] if armor_type else None)
+    
+    def sort_column(self, name):
+        'Column of human_readable_df for every catalog row without building the frame'
+        columns = self.catalog.sort_columns
+        if name not in columns:
+            stats = self.catalog.group('stats')
+            if name == 'armor':
+                values = stats['armor'].to_numpy()
+            elif name in self.bonus_stats:
+                # later spell of an item overwrites earlier one, as in human_readable_df
+                values = np.zeros(stats.shape[0], dtype=np.int64)
+                bonus = self.bonus_stats.index(name)
+                for i in range(3):
+                    rows = self.catalog.bonus_index[:, i] == bonus
+                    values[rows] = self.catalog.bonus_value[rows, i]
+            else:
+                values = np.zeros(stats.shape[0], dtype=np.int64)
+                stat_type = self.stat_map[name]
+                for i in range(1, 6):
+                    rows = stats['stat_type{}'.format(i)].to_numpy() == stat_type
+                    values[rows] = stats['stat_value{}'.format(i)].to_numpy()[rows]
+            columns[name] = values
+        return columns[name]
+    
+    def top_positions(self, positions, orderby, asc, k):
+        'First k of positions ordered by orderby columns, ties keep catalog order'
+        ascending = asc if isinstance(asc, (list, tuple)) else [asc] * len(orderby)
+        # descending order is ascending order of negated values
+        keys = [self.sort_column(name)[positions] * (1 if up else -1) for name, up in zip(orderby, ascending)]
+        if not keys:
+            return positions[:k]
+        if k < positions.shape[0]:
+            # partial selection on the first key, rows equal to the k-th one are kept for other keys
+            kth = np.partition(keys[0], k - 1)[k - 1]
+            candidates = np.nonzero(keys[0] <= kth)[0]
+        else:
+            candidates = np.arange(positions.shape[0])
+        order = np.lexsort([key[candidates] for key in reversed(keys)])
+        return positions[candidates[order][:k]]
+    
+    def readable_rows(self, positions):
+        'Rows of catalog at positions in human readable form'
+        if self.catalog.readable is not None:
+            return self.catalog.readable.iloc[positions]
+        return self.human_readable_df(self.catalog.columns(*READABLE_GROUPS, positions=positions))
+    
+    @staticmethod
+    def hide_columns(temp, hide_resist=False, hide_additional_spell_power=False):
         # to hide resist
         if hide_resist:
             temp = temp.drop(['holy_res', 'fire_res', 'nature_res',
@@ -573,25 +716,292 @@ class Character:
         return temp
     
     def connect(self):
-        # read config
-        config = configparser.ConfigParser()
-        config.read('main.ini')
-        # connect to database
-        engine = create_engine('mysql+pymysql://{}:{}@localhost/{}'.format(config['SQL']['username'], 
-                                                                           config['SQL']['password'], 
-                                                                           config['SQL']['database']))
-        return engine
+        # engine and its connection pool are shared by every character in the process
+        return get_engine()
+    
+    @staticmethod
+    async def create(game_class, race, executor=None):
+        '''
+        Build character without blocking event loop, catalog and base tables
+        are queried in executor, then the character is built from memory.
+        '''
+        await get_catalog_async(get_engine, executor)
+        # invalid keys are reported by Character itself
+        known = game_class in CLASS_MAP and race in RACE_MAP
+        if known and (game_class, race) not in _base_tables and not get_catalog(get_engine).has_base_stats():
+            engine = get_engine()
+            params = {'cls': CLASS_MAP[game_class], 'race': RACE_MAP[race]}
+            tables = await asyncio.gather(read_sql_async(BASE_HP_MANA_CLASS_QUERY, engine, params, executor),
+                                          read_sql_async(BASE_STATS_CLASS_QUERY, engine, params, executor))
+            _base_tables.setdefault((game_class, race), tuple(tables))
+        return Character(game_class, race)
+    
+    def to_bytes(self):
+        '''
+        Compact binary form: class, race, base stats, items_on and current stats.
+        Catalog and static tables are not stored, see Character.from_bytes.
+        '''
+        filled = [(SLOT_INDEX[slot], ids) for slot, ids in self.items_on.items() if ids is not None]
+        stats = self.stat_vector()
+        data = [SAVE_HEADER.pack(SAVE_MAGIC, SAVE_VERSION, self.class_map[self.game_class], 
+                                 self.race_map[self.race], len(filled), len(stats)), 
+                SAVE_BASE.pack(self.base_hp, self.base_mana, 
+                               *[self.base_stats[column].values[0] for column in BASE_STAT_COLUMNS])]
+        data.extend(SAVE_SLOT.pack(slot, ids) for slot, ids in filled)
+        data.append(struct.pack('<{}d'.format(len(stats)), *stats))
+        return b''.join(data)
+    
+    @staticmethod
+    def from_bytes(data, replay=False):
+        '''
+        Character saved by to_bytes, rebuilt against the shared catalog without database.
+        Saved stats are used as they are unless replay is set, then items are applied again.
+        '''
+        magic, version, class_id, race_id, filled, stats_size = SAVE_HEADER.unpack_from(data, 0)
+        if magic != SAVE_MAGIC:
+            raise ValueError('Not a saved character')
+        if version > SAVE_VERSION:
+            raise ValueError('Unsupported save version: {}'.format(version))
+        offset = SAVE_HEADER.size
+        
+        base = SAVE_BASE.unpack_from(data, offset)
+        offset += SAVE_BASE.size
+        game_class, race = CLASS_REVERSE_MAP[class_id], RACE_REVERSE_MAP[race_id]
+        # base stats from file, so no database query is needed
+        if (game_class, race) not in _base_tables:
+            _base_tables[(game_class, race)] = (pd.DataFrame({'basehp': [base[0]], 'basemana': [base[1]]}), 
+                                                pd.DataFrame({column: [value] for column, value 
+                                                              in zip(BASE_STAT_COLUMNS, base[2:])}))
+        inst = Character(game_class, race)
+        
+        items_on = {}
+        for _ in range(filled):
+            slot, ids = SAVE_SLOT.unpack_from(data, offset)
+            offset += SAVE_SLOT.size
+            items_on[SLOTS[slot]] = ids
+        stats = struct.unpack_from('<{}d'.format(stats_size), data, offset)
+        
+        inst.items_on.update(items_on)
+        if replay or stats_size != len(DELTA_ATTRS):
+            inst.set_stats(inst.gear_stats(inst.items_on))
+        else:
+            inst.set_stats(stats)
+        return inst
+    
+    def __reduce__(self):
+        # pickle only compact form, e.g. when sent between processes
+        return (Character.from_bytes, (self.to_bytes(),))
     
     def save(self, name, path='./characters'):
-        'Save class instance and delete connection to db for security reason'
-        # check if connection is established
-        if 'engine' in self.__dict__:
-            del self.engine
-        pickle.dump(self, open(os.path.join(path, name), 'wb'))
+        'Save character in binary form, connection to database is never stored'
+        with open(os.path.join(path, name), 'wb') as f_out:
+            f_out.write(self.to_bytes())
         
     @staticmethod    
-    def load(name, path='./characters'):
-        'Load class instance and create new connection to database'
-        inst = pickle.load(open(os.path.join(path, name), 'rb'))
-        inst.engine = inst.connect()
-        return inst
\ No newline at end of file
+    def load(name, path='./characters', replay=False):
+        'Load character, files pickled by older versions are converted, their items are worn again'
+        with open(os.path.join(path, name), 'rb') as f_in:
+            data = f_in.read()
+        if not data.startswith(SAVE_MAGIC):
+            # only class, race and items are taken, the rest of old pickle is not usable
+            legacy = pickle.loads(data)
+            inst = Character(legacy.game_class, legacy.race)
+            inst.items_on.update((slot, ids) for slot, ids in legacy.items_on.items() if slot in inst.items_on)
+            inst.set_stats(inst.gear_stats(inst.items_on))
+            return inst
+        return Character.from_bytes(data, replay)
+
+
+# naked characters of every class and race shared by CharacterState instances
+_templates = {}
+
+
+def character_template(game_class, race):
+    'Naked Character of class and race, created on first use and again when process-wide catalog is replaced'
+    template = _templates.get((game_class, race))
+    if template is None or template.catalog is not get_catalog(get_engine):
+        template = _templates[(game_class, race)] = Character(game_class, race)
+    return template
+
+
+def summary_from_stats(template, stats, hide_resist=False):
+    'Character.summary of a character of template class and race with given DELTA_ATTRS values'
+    stats = derived_stats(stats, template.base_hp, template.base_mana, template.coefficients)
+    orddict = OrderedDict()
+    for key, value in zip(BATCH_STATS, stats):
+        if key in RESIST_TYPE:
+            if hide_resist:
+                orddict[key] = value
+        elif key == 'physical_reduction':
+            orddict[key] = round(value, 3)
+        else:
+            orddict[key] = round(value, 1)
+    return orddict
+
+
+class CharacterState:
+    '''
+    Compact state of a character for mass simulation. Static tables, catalog and
+    base stats are shared through the naked Character of the same class and race.
+    '''
+    __slots__ = ('game_class', 'race', 'stats', 'gear', 'catalog', 'generation')
+    
+    def __init__(self, game_class, race, stats=None, gear=None):
+        template = character_template(game_class, race)
+        self.game_class = template.game_class
+        self.race = template.race
+        # values of catalog.DELTA_ATTRS, derived stats are calculated on demand
+        self.stats = template.naked.copy() if stats is None else stats
+        # item id in every slot of SLOTS, 0 is an empty slot
+        self.gear = np.zeros(len(SLOTS), dtype=np.int32) if gear is None else gear
+        # catalog and its generation stats were taken from, see template
+        self.catalog, self.generation = template.catalog, template.catalog.generation
+    
+    def items_on(self):
+        return {slot: int(ids) if ids else None for slot, ids in zip(SLOTS, self.gear)}
+    
+    def template(self):
+        '''
+        Naked Character of class and race. Stats are taken from current catalog rows
+        when catalog or its rows were replaced since the last change, as Character.refresh_stats does.
+        '''
+        template = character_template(self.game_class, self.race)
+        catalog = template.catalog
+        if catalog is not self.catalog or catalog.generation != self.generation:
+            # items no longer in catalog are taken off
+            for i, ids in enumerate(self.gear):
+                if ids and ids not in catalog.index:
+                    self.gear[i] = 0
+            self.stats = template.gear_stats(self.items_on())
+            self.catalog, self.generation = catalog, catalog.generation
+        return template
+    
+    def wear_item(self, ids):
+        template = self.template()
+        position = template.catalog.position(ids)
+        slot, freed = equip_slot(self.items_on(), INVENTORY_SLOT[template.catalog.inventory_type[position]])
+        
+        # check if character can wear it
+        if template.catalog.allowable_class[position] not in (-1, CLASS_MAP[self.game_class]):
+            raise KeyError('Can\'t be used by your class.')
+        
+        for other in freed:
+            self.gear[SLOT_INDEX[other]] = 0
+        
+        self.gear[SLOT_INDEX[slot]] = ids
+        # the same sum as Character.wear_item, so both give the same stats
+        self.stats = template.gear_stats(self.items_on())
+    
+    def remove_item(self, slot):
+        template = self.template()
+        slot = SLOT_INDEX[template.valid_key(slot, SLOT_INDEX)]
+        if self.gear[slot] == 0:
+            raise KeyError('No item with such id.')
+        self.gear[slot] = 0
+        self.stats = template.gear_stats(self.items_on())
+    
+    def summary(self, hide_resist=False):
+        'Same as Character.summary'
+        return summary_from_stats(self.template(), self.stats, hide_resist)
+    
+    def to_character(self):
+        'Full Character with the same gear and stats'
+        template = self.template()
+        character = copy.copy(template)
+        character.items_on = self.items_on()
+        character.set_stats(self.stats)
+        character.generation = self.generation
+        return character
+
+
+SummaryCacheInfo = namedtuple('SummaryCacheInfo', ['hits', 'prefix_hits', 'misses', 'maxsize', 'currsize'])
+
+
+class SummaryCache:
+    '''
+    Bounded LRU cache of summary() of gear sets keyed by class, race and items_on.
+    Stats of every gear prefix (items of the first slots of SLOTS) are cached too,
+    so a gear set that differs from a cached one in a late slot starts from the
+    shared prefix. Items are not checked against slot rules, see wear_item.
+    '''
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        # (class, race, item ids of the first slots) -> sum of item deltas,
+        # (class, race, item ids of all slots, hide_resist) -> summary
+        self.entries = OrderedDict()
+        # catalog and its generation cached values were taken from
+        self.catalog = self.generation = None
+        self.hits = self.prefix_hits = self.misses = 0
+    
+    def stats(self, game_class, race, items_on):
+        'DELTA_ATTRS values of a character of class and race wearing items_on'
+        template, key = self._key(game_class, race, items_on)
+        if key in self.entries:
+            self.hits += 1
+            gear = self._get(key)
+        else:
+            gear = self._calculate(template, key)
+        # the same sum as Character.gear_stats
+        return template.naked + gear * template.delta_scale
+    
+    def summary(self, game_class, race, items_on, hide_resist=False):
+        'Same as Character.summary of a character of class and race wearing items_on'
+        template, key = self._key(game_class, race, items_on)
+        if key + (hide_resist,) in self.entries:
+            self.hits += 1
+            return OrderedDict(self._get(key + (hide_resist,)))
+        orddict = summary_from_stats(template, self.stats(game_class, race, items_on), hide_resist)
+        self._store(key + (hide_resist,), orddict)
+        # copy so changes made by caller do not reach the cache
+        return OrderedDict(orddict)
+    
+    def info(self):
+        return SummaryCacheInfo(self.hits, self.prefix_hits, self.misses, self.maxsize, len(self.entries))
+    
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.prefix_hits = self.misses = 0
+    
+    def _key(self, game_class, race, items_on):
+        template = character_template(game_class, race)
+        catalog = get_catalog(get_engine)
+        if catalog is not self.catalog or catalog.generation != self.generation:
+            # catalog or its rows were replaced, cached values may be stale
+            self.entries.clear()
+            self.catalog, self.generation = catalog, catalog.generation
+        return template, (template.game_class, template.race, tuple(items_on.get(slot) for slot in SLOTS))
+    
+    def _calculate(self, template, key):
+        catalog = template.catalog
+        ids = key[2]
+        # the longest prefix already known
+        start, gear = 0, np.zeros(len(DELTA_ATTRS))
+        gear.flags.writeable = False
+        for end in range(len(ids) - 1, 0, -1):
+            prefix = key[:2] + (ids[:end],)
+            if prefix in self.entries:
+                self.prefix_hits += 1
+                start, gear = end, self._get(prefix)
+                break
+        else:
+            self.misses += 1
+        
+        for end in range(start, len(ids)):
+            # prefixes that end with empty slot are the same as shorter ones
+            if ids[end] is None:
+                continue
+            gear = gear + catalog.deltas[catalog.position(ids[end])]
+            gear.flags.writeable = False
+            self._store(key[:2] + (ids[:end + 1],), gear)
+        self._store(key, gear)
+        return gear
+    
+    def _get(self, key):
+        self.entries.move_to_end(key)
+        return self.entries[key]
+    
+    def _store(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
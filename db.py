@@ -0,0 +1,81 @@
+import asyncio
+import configparser
+import threading
+from functools import partial
+
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+# pool settings used when main.ini has none
+POOL_DEFAULTS = {'pool_size': 5, 'max_overflow': 10, 'pool_recycle': 3600, 'pool_timeout': 30}
+
+# one engine, and so one connection pool, per database url in the process
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def read_config(path='main.ini'):
+    'SQL section of config file as dict'
+    config = configparser.ConfigParser()
+    config.read(path)
+    if 'SQL' not in config:
+        raise KeyError('No SQL section in {}, run fill_db.py first'.format(path))
+    return dict(config['SQL'])
+
+
+def engine_url(config):
+    'Database url from SQL section, url key wins over username, password and database'
+    if config.get('url'):
+        return config['url']
+    return 'mysql+pymysql://{}:{}@{}/{}'.format(config['username'], config['password'],
+                                                config.get('host', 'localhost'), config['database'])
+
+
+def pool_options(config):
+    'Pool settings from SQL section, e.g. pool_size = 20'
+    options = {key: int(config.get(key, value)) for key, value in POOL_DEFAULTS.items()}
+    # connections are checked before use, server closes idle ones after wait_timeout
+    options['pool_pre_ping'] = True
+    return options
+
+
+def get_engine(path='main.ini'):
+    'Process-wide engine for database of config file, created on first use'
+    config = read_config(path)
+    url = engine_url(config)
+    if url not in _engines:
+        with _engines_lock:
+            if url not in _engines:
+                # sqlite picks its own pool, sizes only apply to server databases
+                options = {} if url.startswith('sqlite') else pool_options(config)
+                _engines[url] = create_engine(url, **options)
+    return _engines[url]
+
+
+def set_engine(engine, path='main.ini'):
+    'Use given engine for database of config file, e.g. sqlite one in tests'
+    with _engines_lock:
+        _engines[engine_url(read_config(path))] = engine
+    return engine
+
+
+def dispose_engines():
+    'Close every pooled connection, e.g. in a worker process after fork'
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+
+
+def read_sql(query, engine, params=None):
+    'DataFrame of query, params are bound by name as :name'
+    return pd.read_sql_query(text(query), engine, params=params)
+
+
+async def read_sql_async(query, engine, params=None, executor=None):
+    '''
+    read_sql that does not block event loop, query runs in executor
+    (default thread pool) on a connection from the shared pool.
+    '''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(read_sql, query, engine, params))
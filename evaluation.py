@@ -0,0 +1,113 @@
+import numpy as np
+
+from catalog import DELTA_ATTRS, RESIST_TYPE
+
+# columns of evaluate_gear result, same names and order as Character.summary(hide_resist=True)
+BATCH_STATS = ('hp', 'mana', 'mana_reg', 'stamina', 'strength', 'intellect', 'agility',
+               'spirit', 'armor', 'physical_reduction', 'melee_ap', 'range_ap',
+               'spell_power', 'healing_power', 'crit', 'spell_crit', 'hit_chance',
+               'dodge', 'parry', 'defence') + RESIST_TYPE
+
+# summary names of stats that are attributes of a character without any change
+PRIMARY_SUMMARY = {'stamina': 'sta', 'strength': 'str', 'intellect': 'inte', 'agility': 'agi',
+                   'spirit': 'spi', 'spell_power': 'spell_power', 'healing_power': 'healing_power',
+                   'hit_chance': 'hit_chance', 'parry': 'parry', 'defence': 'defence'}
+
+# summary names of stats calculated from other ones to attributes of Character
+DERIVED_ATTRS = {'hp': 'hp', 'mana': 'mana', 'mana_reg': 'mana_reg', 'armor': 'armor',
+                 'melee_ap': 'melee_attack_power', 'range_ap': 'range_attack_power',
+                 'crit': 'crit', 'spell_crit': 'spell_crit', 'dodge': 'dodge'}
+
+
+def class_coefficients(game_class, race):
+    'Multipliers used by Character.calculate_stats for class and race as plain floats'
+    return {
+        'hp_per_sta': 10.5 if race == 'tauren' else 10.,
+        'mana_per_inte': 15.,
+        'armor_per_agi': 2.,
+        # melee attack power from strenght and agility
+        'melee_ap_per_str': 1. if game_class in ('hunter', 'mage', 'prist', 'rogue', 'warlock') else 2.,
+        'melee_ap_per_agi': 1. if game_class in ('rogue', 'druid', 'hunter') else 0.,
+        # only these classes have range attack power at all
+        'range_ap': 1. if game_class in ('rogue', 'warrior', 'hunter') else 0.,
+        'range_ap_per_agi': {'rogue': 1., 'warrior': 1., 'hunter': 2.}.get(game_class, 0.),
+        'crit_per_agi': {'druid': 1 / 20, 'paladin': 1 / 20, 'shaman': 1 / 20, 'warrior': 1 / 20,
+                         'rogue': 1 / 29, 'hunter': 1 / 53}.get(game_class, 0.),
+        'spell_crit_per_inte': 1 / 54 if game_class == 'paladin' else 1 / 60,
+        # warriors and rogues have no mana regeneration
+        'mana_reg': 0. if game_class in ('warrior', 'rogue') else 1.,
+        'mana_reg_per_spi': {'mage': 1 / 4, 'prist': 1 / 4,
+                             'warrior': 0., 'rogue': 0.}.get(game_class, 1 / 5),
+        'dodge_per_agi': {'rogue': 1 / 14.5, 'hunter': 1 / 26}.get(game_class, 1 / 20),
+    }
+
+
+def physical_damage_reduction(armor, attacker_level=60):
+    return armor / (armor + (467.5 * attacker_level - 22167.5))
+
+
+def reduction_slope(armor, attacker_level=60):
+    'Change of physical_damage_reduction per +1 armor at given armor'
+    k = 467.5 * attacker_level - 22167.5
+    return k / (armor + k) ** 2
+
+
+def derived_stats(primary, base_hp, base_mana, coefficients):
+    'BATCH_STATS from array of DELTA_ATTRS values, last axis is the stat one'
+    primary = np.asarray(primary, dtype=float)
+    attr = {name: primary[..., i] for i, name in enumerate(DELTA_ATTRS)}
+    c = coefficients
+
+    stats = {}
+    stats['hp'] = base_hp + attr['sta'] * c['hp_per_sta'] + attr['bonus_hp']
+    stats['mana'] = base_mana + attr['inte'] * c['mana_per_inte']
+    stats['mana_reg'] = (attr['mana_reg_bonus'] + attr['spi'] * c['mana_reg_per_spi']) * c['mana_reg']
+    stats['armor'] = attr['agi'] * c['armor_per_agi'] + attr['base_armor']
+    stats['physical_reduction'] = physical_damage_reduction(stats['armor'])
+    stats['melee_ap'] = (attr['base_attack_power'] + attr['str'] * c['melee_ap_per_str'] +
+                         attr['agi'] * c['melee_ap_per_agi'])
+    stats['range_ap'] = attr['base_attack_power'] * c['range_ap'] + attr['agi'] * c['range_ap_per_agi']
+    stats['crit'] = attr['base_crit'] + attr['agi'] * c['crit_per_agi']
+    stats['spell_crit'] = attr['base_spell_crit'] + attr['inte'] * c['spell_crit_per_inte']
+    stats['dodge'] = attr['base_dodge'] + attr['agi'] * c['dodge_per_agi']
+    for key, name in PRIMARY_SUMMARY.items():
+        stats[key] = attr[name]
+    for resist_type in RESIST_TYPE:
+        stats[resist_type] = attr[resist_type]
+
+    return np.stack([np.broadcast_to(stats[key], primary.shape[:-1]) for key in BATCH_STATS], axis=-1)
+
+
+def gear_primary(character, ids, empty=0):
+    'DELTA_ATTRS values of character class and race wearing N gear sets of N x slots item ids'
+    catalog = character.catalog
+    ids = np.asarray(ids)
+    if ids.ndim == 1:
+        ids = ids[np.newaxis, :]
+    gear = np.zeros((ids.shape[0], len(DELTA_ATTRS)))
+    for slot in range(ids.shape[1]):
+        rows = ids[:, slot] != empty
+        gear[rows] += catalog.deltas[catalog.positions(ids[rows, slot])]
+    # racial bonuses to intellect and spirit apply to items only
+    return character.naked + gear * character.delta_scale
+
+
+def evaluate_gear(character, ids, empty=0):
+    '''
+    Stats of N gear sets at once, returns N x BATCH_STATS array.
+    Class and race are taken from character, gear it wears is ignored.
+    Slot rules of wear_item are not checked, every id given is counted.
+    '''
+    return derived_stats(gear_primary(character, ids, empty), character.base_hp, character.base_mana,
+                         character.coefficients)
+
+
+def stat_matrix(coefficients):
+    '''
+    Change of every BATCH_STATS value per +1 of every DELTA_ATTRS value,
+    physical_reduction is not linear in armor so its column is left as zero.
+    '''
+    eye = np.eye(len(DELTA_ATTRS))
+    matrix = derived_stats(eye, 0, 0, coefficients) - derived_stats(np.zeros(len(DELTA_ATTRS)), 0, 0, coefficients)
+    matrix[:, BATCH_STATS.index('physical_reduction')] = 0
+    return matrix
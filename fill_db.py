@@ -1,50 +1,170 @@
 #! /usr/bin/python3
+import argparse
 import configparser
 import os
+import re
+import shutil
 import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
+
+from catalog import APPLIED_TABLE, UPDATES_PATH, update_number
+from db import get_engine, read_config
 
 DB_PATH = './Full_DB'
-UPDATES_PATH = './updates'
+DUMP_NAME = 'ClassicDB_1_7_z2684.sql'
+
+# files are fed to mysql in chunks, a dump is never read into memory at once
+CHUNK_SIZE = 1 << 20
+
+# statements that start a new table in a dump
+TABLE_START = re.compile(rb'^(?:DROP TABLE IF EXISTS|CREATE TABLE(?: IF NOT EXISTS)?) `([^`]+)`')
+
 
-if 'main.ini' not in os.listdir():
+def create_config():
     config = configparser.ConfigParser()
     print('Type username, password and database name separated with whitespace')
     print('If you didn\'t create new user and new database you can leave and create them')
     print('Press CTRL + C to leave')
     username, password, database = input().split(' ')
-    
+
     config['SQL'] = {'username': username, 'password': password, 'database': database}
     with open('main.ini', 'w') as configfile:
         config.write(configfile)
 
-config = configparser.ConfigParser()
-config.read('main.ini')
+
+def mysql_command(config):
+    cmd = ['mysql', '-u', config['username'], '-p' + config['password'], '-D', config['database']]
+    if config.get('host'):
+        cmd += ['-h', config['host']]
+    return cmd
+
+
+def run_files(config, paths):
+    'Stream files one after another into a single mysql session'
+    process = subprocess.Popen(mysql_command(config), stdin=subprocess.PIPE)
+    try:
+        for path in paths:
+            with open(path, 'rb') as f_in:
+                shutil.copyfileobj(f_in, process.stdin, CHUNK_SIZE)
+    except BrokenPipeError:
+        # mysql stopped on error, its message is already printed
+        pass
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+    if process.wait() != 0:
+        raise RuntimeError('mysql failed on {}'.format(paths[-1]))
+
+
+def applied_files(engine):
+    'Set of names of files recorded as applied'
+    with engine.begin() as conn:
+        conn.execute(text('CREATE TABLE IF NOT EXISTS {} ('
+                          'name VARCHAR(255) PRIMARY KEY, '
+                          'applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)'.format(APPLIED_TABLE)))
+        return {row[0] for row in conn.execute(text('SELECT name FROM {}'.format(APPLIED_TABLE)))}
+
+
+def mark_applied(engine, name):
+    with engine.begin() as conn:
+        conn.execute(text('INSERT INTO {} (name) VALUES (:name)'.format(APPLIED_TABLE)), {'name': name})
 
 
-engine = create_engine('mysql+pymysql://{}:{}@localhost/{}'.format(config['SQL']['username'],
-                                                                   config['SQL']['password'],
-                                                                   config['SQL']['database']))
+def update_files(path=UPDATES_PATH):
+    'Update files in the order they have to be applied'
+    return sorted((name for name in os.listdir(path) if name.endswith('.sql')), key=update_number)
 
-# main database
-with open(os.path.join(DB_PATH, 'ClassicDB_1_7_z2684.sql'), 'rb') as f_in:
-    cmd = f_in.read()
 
-subprocess.run(['mysql', '-u', config['SQL']['username'],
-                '-p' + config['SQL']['password'],
-                '-D', config['SQL']['database']],
-               input=cmd)
+def split_dump(path, out_dir):
+    '''
+    Split dump into a header file and one file per table, reading it line by line.
+    Returns path of header and list of (table, path). A table file drops and fills
+    its table, so tables can be loaded in any order and loaded again after failure.
+    '''
+    header = os.path.join(out_dir, 'header.sql')
+    tables = []
+    f_out = open(header, 'wb')
+    with open(path, 'rb') as f_in:
+        for line in f_in:
+            start = TABLE_START.match(line)
+            if start and (not tables or start.group(1).decode() != tables[-1][0]):
+                f_out.close()
+                table = start.group(1).decode()
+                tables.append((table, os.path.join(out_dir, '{:04d}.sql'.format(len(tables)))))
+                f_out = open(tables[-1][1], 'wb')
+            f_out.write(line)
+    f_out.close()
+    return header, tables
 
 
-# updates for database
-for file in os.listdir(UPDATES_PATH):
+def load_dump(config, engine, path, applied, processes):
+    'Load tables of the base dump in parallel, every loaded table is recorded'
+    name = os.path.basename(path)
+    if name in applied:
+        print('Skip {}, already applied'.format(name))
+        return
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        header, tables = split_dump(path, out_dir)
+        if not tables:
+            # unknown layout of dump, it is loaded as a whole
+            run_files(config, [header])
+        else:
+            todo = [(table, table_path) for table, table_path in tables
+                    if '{}:{}'.format(name, table) not in applied]
+            print('Loading {} of {} tables from {}'.format(len(todo), len(tables), name))
+
+            def load_table(table, table_path):
+                # session settings of header (charset, checks) are needed by every table
+                run_files(config, [header, table_path])
+                mark_applied(engine, '{}:{}'.format(name, table))
+
+            with ThreadPoolExecutor(max_workers=processes) as executor:
+                futures = [executor.submit(load_table, table, table_path) for table, table_path in todo]
+                errors = [future.exception() for future in futures if future.exception()]
+            if errors:
+                raise errors[0]
+    mark_applied(engine, name)
+
+
+def apply_updates(config, engine, path, applied):
+    'Apply update files in numeric order, stops on the first failed one'
+    for name in update_files(path):
+        if name in applied:
+            continue
+        print('Applying {}'.format(name))
+        run_files(config, [os.path.join(path, name)])
+        mark_applied(engine, name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fill database with ClassicDB dump and updates')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help='number of tables of the dump loaded at once')
+    parser.add_argument('--dump', default=os.path.join(DB_PATH, DUMP_NAME))
+    parser.add_argument('--updates', default=UPDATES_PATH)
+    args = parser.parse_args()
+
+    if 'main.ini' not in os.listdir():
+        create_config()
+
+    config = read_config()
+    engine = get_engine()
+    applied = applied_files(engine)
+
     try:
-        with open(os.path.join(UPDATES_PATH, file), 'rb') as f_in:
-            cmd = f_in.read()
-        subprocess.run(['mysql', '-u', config['SQL']['username'],
-                        '-p' + config['SQL']['password'],
-                        '-D', config['SQL']['database']],
-                       input=cmd)
-    except:
-        print('An exception occurred with update: {}'.format(file))
\ No newline at end of file
+        load_dump(config, engine, args.dump, applied, args.processes)
+        apply_updates(config, engine, args.updates, applied)
+    except RuntimeError as e:
+        print('{}, run fill_db.py again to continue'.format(e))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
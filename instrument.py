@@ -0,0 +1,170 @@
+'''
+Opt-in timing of Character methods and database queries.
+
+Methods are wrapped only between enable() and disable(), so there is no
+overhead at all when instrumentation is off.
+'''
+import time
+import pstats
+import inspect
+import cProfile
+import functools
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+import db
+import catalog
+import character
+
+# latencies kept per name for percentiles, counts and totals are exact
+SAMPLES = 10000
+
+_records = {}
+_records_lock = threading.Lock()
+# (owner, attribute) -> original value, filled while enabled
+_originals = {}
+
+
+class _Record:
+    __slots__ = ('calls', 'total', 'samples')
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.
+        self.samples = deque(maxlen=SAMPLES)
+
+
+def record(name, seconds):
+    'Add one call of name that took seconds'
+    with _records_lock:
+        entry = _records.get(name)
+        if entry is None:
+            entry = _records[name] = _Record()
+        entry.calls += 1
+        entry.total += seconds
+        entry.samples.append(seconds)
+
+
+def _timed(func, name):
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+    return wrapper
+
+
+def default_targets():
+    'Public methods of Character and functions that query database as (owner, attribute, name)'
+    targets = [(character.Character, '__init__', 'Character.__init__')]
+    for attr, value in vars(character.Character).items():
+        if not attr.startswith('_') and (inspect.isfunction(value) or isinstance(value, staticmethod)):
+            targets.append((character.Character, attr, 'Character.{}'.format(attr)))
+    # character.read_sql is the name imported by Character.__init__,
+    # db.read_sql is called by read_sql_async of Character.create
+    targets += [(character, 'read_sql', 'sql.base_tables'),
+                (db, 'read_sql', 'sql.base_tables_async'),
+                (catalog.ItemCatalog, 'from_db', 'sql.catalog'),
+                (catalog, 'read_item_columns', 'sql.item_columns'),
+                (catalog.ItemCatalog, 'apply_changes', 'sql.catalog_changes'),
+                (catalog, 'content_version', 'sql.content_version'),
+                (catalog, 'applied_updates', 'sql.applied_updates')]
+    return targets
+
+
+def enable(targets=None):
+    'Start timing targets, see default_targets'
+    for owner, attr, name in default_targets() if targets is None else targets:
+        if (owner, attr) in _originals:
+            continue
+        original = vars(owner)[attr]
+        _originals[(owner, attr)] = original
+        if isinstance(original, staticmethod):
+            wrapped = staticmethod(_timed(original.__func__, name))
+        elif isinstance(original, classmethod):
+            wrapped = classmethod(_timed(original.__func__, name))
+        else:
+            wrapped = _timed(original, name)
+        setattr(owner, attr, wrapped)
+
+
+def disable():
+    'Put original methods back, recorded stats are kept'
+    for (owner, attr), original in _originals.items():
+        setattr(owner, attr, original)
+    _originals.clear()
+
+
+def enabled():
+    return bool(_originals)
+
+
+def reset():
+    with _records_lock:
+        _records.clear()
+
+
+def stats():
+    'Dict of name -> calls, total, mean, p50, p90, p99 and max in seconds'
+    result = {}
+    for name, entry in sorted(_records.items()):
+        samples = np.array(entry.samples)
+        p50, p90, p99 = np.percentile(samples, (50, 90, 99))
+        result[name] = {'calls': entry.calls, 'total': entry.total, 'mean': entry.total / entry.calls,
+                        'p50': p50, 'p90': p90, 'p99': p99, 'max': samples.max()}
+    return result
+
+
+def report(sort='total'):
+    'Stats as text table sorted by given column'
+    lines = ['{:<36} {:>8} {:>10} {:>10} {:>10} {:>10}'.format('name', 'calls', 'total', 'mean', 'p90', 'p99')]
+    for name, row in sorted(stats().items(), key=lambda item: -item[1][sort]):
+        lines.append('{:<36} {:>8} {:>10.4f} {:>10.6f} {:>10.6f} {:>10.6f}'.format(
+            name, row['calls'], row['total'], row['mean'], row['p90'], row['p99']))
+    return '\n'.join(lines)
+
+
+@contextmanager
+def profile(path=None, sort='cumulative', limit=30):
+    '''
+    Capture cProfile of the block, e.g.
+        with instrument.profile('swap.prof') as profiler:
+            character.wear_item(ids)
+    Profile is saved to path if given, otherwise the top of it is printed.
+    '''
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if path:
+            profiler.dump_stats(path)
+        else:
+            pstats.Stats(profiler).sort_stats(sort).print_stats(limit)
+
+
+@contextmanager
+def timing(targets=None):
+    'Enable instrumentation for the block only'
+    was_enabled = enabled()
+    enable(targets)
+    try:
+        yield
+    finally:
+        if not was_enabled:
+            disable()
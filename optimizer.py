@@ -0,0 +1,310 @@
+from itertools import combinations
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from catalog import BONUS_ATTR_NAME, DELTA_ATTRS
+from character import INVENTORY_SLOT, SLOT_CONFLICTS, SLOT_INDEX, SLOTS
+from evaluation import BATCH_STATS, evaluate_gear, physical_damage_reduction, reduction_slope, stat_matrix
+
+# slots that never conflict with other ones in wear_item
+SINGLE_SLOTS = ('head', 'neck', 'shoulders', 'chest', 'waist', 'legs', 'feet', 'wrists',
+                'hands', 'back', 'thrown', 'relic')
+
+# two different items of the same type can be worn at once
+PAIR_SLOTS = (('finger1', 'finger2'), ('trinket1', 'trinket2'))
+
+# only one of them can be worn, bow items share InventoryType with ranged slot
+RANGED_SLOTS = ('ranged', 'gun')
+
+# slots where search filters items by armor_type
+ARMOR_SLOTS = ('head', 'shoulders', 'chest', 'waist', 'legs', 'feet', 'wrists', 'hands')
+
+# attributes marginal_stats reports change of summary stats for
+MARGINAL_ATTRS = ('sta', 'str', 'agi', 'inte', 'spi') + BONUS_ATTR_NAME
+
+
+def _dominated(values, armor, keep=1):
+    'Mask of options dominated by at least keep other ones'
+    n = values.shape[0]
+    count = np.zeros(n, dtype=np.int64)
+    index = np.arange(n)
+    # chunks keep memory of n x n comparison bounded
+    for start in range(0, n, 1024):
+        stop = min(start + 1024, n)
+        v, a, i = values[start:stop, None], armor[start:stop, None], index[start:stop, None]
+        better = (values >= v) & (armor >= a) & ((values > v) | (armor > a))
+        # equal options, the first one is kept
+        equal = (values == v) & (armor == a) & (index < i)
+        count[start:stop] = (better | equal).sum(axis=1)
+    return count >= keep
+
+
+class _Group:
+    'Mutually exclusive ways to fill a set of slots, each option is a tuple of (slot, id)'
+    def __init__(self, values, armor, options):
+        self.values = np.asarray(values, dtype=float)
+        self.armor = np.asarray(armor, dtype=float)
+        self.options = options
+
+    def prune(self, direction):
+        keep = ~_dominated(self.values, self.armor * direction)
+        return _Group(self.values[keep], self.armor[keep], [o for o, k in zip(self.options, keep) if k])
+
+
+def _branch_and_bound(groups, base_value, base_armor, armor_weight, first=None):
+    '''
+    Best choice of one option per group, groups are pairs of (values, armor) arrays.
+    first restricts options of the first group, it is used to split work between processes.
+    '''
+    n = len(groups)
+    direction = np.sign(armor_weight)
+    # best possible rest of the gear for every depth, valid because objective
+    # is linear in values and monotone in armor
+    rest_value = np.zeros(n + 1)
+    rest_armor = np.zeros(n + 1)
+    rest_min_armor = np.zeros(n + 1)
+    for g in range(n - 1, -1, -1):
+        values, armor = groups[g]
+        rest_value[g] = rest_value[g + 1] + values.max()
+        rest_armor[g] = rest_armor[g + 1] + (armor.max() if direction >= 0 else armor.min())
+        rest_min_armor[g] = rest_min_armor[g + 1] + armor.min()
+
+    def objective(value, armor):
+        return value + armor_weight * physical_damage_reduction(armor)
+
+    def tangent(g, value, armor, point):
+        # reduction is concave in armor, its tangent at any point is above it,
+        # so under the tangent the rest of the gear is maximized group by group
+        slope = armor_weight * reduction_slope(point)
+        rest, rest_armor = 0, 0
+        for values, armor_values in groups[g:]:
+            i = (values + slope * armor_values).argmax()
+            rest += values[i] + slope * armor_values[i]
+            rest_armor += armor_values[i]
+        result = value + armor_weight * physical_damage_reduction(point) + slope * (armor - point) + rest
+        return result, armor + rest_armor
+
+    def bound(g, value, armor):
+        # rest of the gear with best values and best armor independently
+        result = objective(value + rest_value[g], armor + rest_armor[g])
+        if armor_weight > 0:
+            # tangent at the least armor gear can have, then at armor of the gear it picked
+            tangent_bound, point = tangent(g, value, armor, armor + rest_min_armor[g])
+            result = min(result, tangent_bound, tangent(g, value, armor, point)[0])
+        return result
+
+    best = [-np.inf, None]
+    chosen = [0] * n
+
+    def search(g, value, armor):
+        if g == n:
+            score = objective(value, armor)
+            if score > best[0]:
+                best[0], best[1] = score, list(chosen)
+            return
+        if bound(g, value, armor) <= best[0]:
+            return
+        values, armor_values = groups[g]
+        options = range(len(values)) if g > 0 or first is None else first
+        # most promising options first to tighten the bound early
+        for i in sorted(options, key=lambda i: -objective(values[i], armor_values[i] + base_armor)):
+            chosen[g] = i
+            search(g + 1, value + values[i], armor + armor_values[i])
+
+    search(0, base_value, base_armor)
+    return best[0], best[1]
+
+
+def _check_filters(character, weights, quality, armor_type):
+    'Check stat names of weights, quality and armor_type, return valid armor_type'
+    for stat in weights:
+        if stat not in BATCH_STATS:
+            print('Valid stats', BATCH_STATS)
+            raise KeyError('Invalid stat name: {}'.format(stat))
+    for item_quality in quality:
+        character.valid_key(item_quality, character.item_quality_map)
+    if armor_type:
+        armor_type = character.valid_key(armor_type, character.item_subclass_map)
+    return armor_type
+
+
+def best_in_slot(character, weights, quality=('uncommon', 'rare', 'epic'), armor_type='', processes=None):
+    '''
+    Gear maximizing sum of weight * stat over summary() stats, e.g. {'healing_power': 1, 'mana_reg': 0.4}.
+    Returns dict of slot -> item id and value of the objective.
+    Class, race and armor_type filter candidates the same way as search does, gear
+    character wears is not taken into account. With processes the search is split
+    over a process pool.
+    '''
+    armor_type = _check_filters(character, weights, quality, armor_type)
+
+    catalog = character.catalog
+    weight = np.array([weights.get(stat, 0.) for stat in BATCH_STATS], dtype=float)
+    armor_weight = weight[BATCH_STATS.index('physical_reduction')]
+    weight[BATCH_STATS.index('physical_reduction')] = 0
+    direction = np.sign(armor_weight)
+    matrix = stat_matrix(character.coefficients)
+    # every item is reduced to its value for linear stats and armor it adds
+    item_value = matrix @ weight
+    item_armor = matrix[:, BATCH_STATS.index('armor')]
+
+    base = evaluate_gear(character, np.zeros((1, 0), dtype=np.int64))[0]
+    base_value = float(base @ weight)
+    base_armor = float(base[BATCH_STATS.index('armor')])
+
+    def candidates(slot, keep=1):
+        subclass = character.item_subclass_map[armor_type] if armor_type and slot in ARMOR_SLOTS else None
+        positions = np.concatenate([catalog.search_positions(character.item_type_map[slot],
+                                                             character.class_map[character.game_class],
+                                                             character.item_quality_map[item_quality], subclass)
+                                    for item_quality in quality])
+        deltas = catalog.deltas[positions] * character.delta_scale
+        values, armor = deltas @ item_value, deltas @ item_armor
+        # dominance pruning, for pairs an item is dropped only when two others are better
+        keep = ~_dominated(values, armor * direction, keep)
+        return values[keep], armor[keep], catalog.group('core')['id'].to_numpy()[positions[keep]].tolist()
+
+    def single(slots):
+        values, armor, options = [0.], [0.], [()]
+        for slot in slots:
+            slot_values, slot_armor, ids = candidates(slot)
+            values.extend(slot_values)
+            armor.extend(slot_armor)
+            options.extend(((slot, i),) for i in ids)
+        return _Group(values, armor, options).prune(direction)
+
+    def pair(slots):
+        slot_values, slot_armor, ids = candidates(slots[0], keep=2)
+        values, armor, options = [0.], [0.], [()]
+        for i in range(len(ids)):
+            values.append(slot_values[i])
+            armor.append(slot_armor[i])
+            options.append(((slots[0], ids[i]),))
+        for i, j in combinations(range(len(ids)), 2):
+            values.append(slot_values[i] + slot_values[j])
+            armor.append(slot_armor[i] + slot_armor[j])
+            options.append(((slots[0], ids[i]), (slots[1], ids[j])))
+        return _Group(values, armor, options).prune(direction)
+
+    def weapons():
+        # either two-hand weapon or one-hand weapon with offhand or shield
+        main, off = single(['one-hand']), single(['offhand', 'shield'])
+        two_hand = single(['two_hand'])
+        values, armor, options = list(two_hand.values), list(two_hand.armor), list(two_hand.options)
+        for i in range(len(main.options)):
+            for j in range(len(off.options)):
+                values.append(main.values[i] + off.values[j])
+                armor.append(main.armor[i] + off.armor[j])
+                options.append(main.options[i] + off.options[j])
+        return _Group(values, armor, options).prune(direction)
+
+    groups = [single([slot]) for slot in SINGLE_SLOTS]
+    groups += [pair(slots) for slots in PAIR_SLOTS]
+    groups += [single(RANGED_SLOTS), weapons()]
+    # the group with most options goes first, it is the one split between processes
+    groups.sort(key=lambda group: -len(group.options))
+    arrays = [(group.values, group.armor) for group in groups]
+
+    if processes and processes > 1 and len(groups[0].options) > 1:
+        chunks = [chunk.tolist() for chunk in np.array_split(np.arange(len(groups[0].options)), processes)
+                  if len(chunk)]
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(_branch_and_bound, arrays, base_value, base_armor, armor_weight, chunk)
+                       for chunk in chunks]
+            score, chosen = max((future.result() for future in futures), key=lambda result: result[0])
+    else:
+        score, chosen = _branch_and_bound(arrays, base_value, base_armor, armor_weight)
+
+    gear = {}
+    for group, i in zip(groups, chosen):
+        gear.update(group.options[i])
+    return gear, score
+
+
+def marginal_stats(character, attacker_level=60):
+    '''
+    Change of every summary() stat per +1 of MARGINAL_ATTRS for character in gear it
+    wears, as frame of MARGINAL_ATTRS x BATCH_STATS. All stats but physical_reduction
+    are linear, for it the slope at current armor is given.
+    '''
+    matrix = stat_matrix(character.coefficients)[[DELTA_ATTRS.index(attr) for attr in MARGINAL_ATTRS]]
+    matrix[:, BATCH_STATS.index('physical_reduction')] = (matrix[:, BATCH_STATS.index('armor')] *
+                                                          reduction_slope(character.armor, attacker_level))
+    return pd.DataFrame(matrix, index=list(MARGINAL_ATTRS), columns=list(BATCH_STATS))
+
+
+def stat_values(character, weights, attacker_level=60):
+    'Value of +1 of every MARGINAL_ATTRS as sum of weight * stat, e.g. {\'melee_ap\': 1, \'crit\': 20}'
+    _check_filters(character, weights, (), '')
+    weight = np.array([weights.get(stat, 0.) for stat in BATCH_STATS], dtype=float)
+    return marginal_stats(character, attacker_level) @ weight
+
+
+def upgrade_ranking(character, weights, quality=('uncommon', 'rare', 'epic'), armor_type=''):
+    '''
+    Change of sum of weight * stat for every item character can wear when it replaces
+    gear of its slot, best upgrades first. Returns frame of id, name, slot, upgrade and
+    change of every summary() stat, indexed by catalog position.
+    Items free slots by wear_item rules, two-hand weapon frees one-hand and offhand
+    ones and so on. Ring or trinket replaces the one that gives the larger upgrade.
+    Character is not changed, all items are scored by one matrix product.
+    '''
+    armor_type = _check_filters(character, weights, quality, armor_type)
+
+    catalog = character.catalog
+    items = catalog.group('core')
+    weight = np.array([weights.get(stat, 0.) for stat in BATCH_STATS], dtype=float)
+    matrix = stat_matrix(character.coefficients)
+    armor_column = BATCH_STATS.index('armor')
+    reduction_column = BATCH_STATS.index('physical_reduction')
+
+    # slot of every catalog item, -1 for ones that can't be worn
+    item_slot = np.full(catalog.inventory_type.shape[0], -1)
+    for item_type, slot in INVENTORY_SLOT.items():
+        item_slot[catalog.inventory_type == item_type] = SLOT_INDEX[slot]
+    usable = ((item_slot >= 0) & np.isin(catalog.allowable_class, (-1, character.class_map[character.game_class])) &
+              np.isin(items['Quality'].to_numpy(), [character.item_quality_map[q] for q in quality]))
+    if armor_type:
+        in_armor_slot = np.isin(item_slot, [SLOT_INDEX[slot] for slot in ARMOR_SLOTS])
+        usable &= ~in_armor_slot | (items['subclass'].to_numpy() == character.item_subclass_map[armor_type])
+    positions = np.flatnonzero(usable)
+
+    # stats every item adds, physical_reduction is set below from armor
+    change = (catalog.deltas[positions] * character.delta_scale) @ matrix
+
+    # stats of worn items every slot, empty slots add nothing
+    worn = np.zeros((len(SLOTS), len(BATCH_STATS)))
+    for i, slot in enumerate(SLOTS):
+        if character.items_on[slot] is not None:
+            worn[i] = (catalog.deltas[catalog.position(character.items_on[slot])] * character.delta_scale) @ matrix
+
+    # worn stats every item removes, ring or trinket replaces the first or the second one
+    choices = []
+    for swap in ({}, {'finger1': 'finger2', 'trinket1': 'trinket2'}):
+        freed = np.zeros((len(SLOTS), len(BATCH_STATS)))
+        for i, slot in enumerate(SLOTS):
+            slot = swap.get(slot, slot)
+            for other in (slot,) + SLOT_CONFLICTS.get(slot, ()):
+                freed[i] += worn[SLOT_INDEX[other]]
+        choices.append(freed)
+
+    current = physical_damage_reduction(character.armor)
+    best, best_upgrade = None, None
+    for freed in choices:
+        result = change - freed[item_slot[positions]]
+        result[:, reduction_column] = physical_damage_reduction(character.armor + result[:, armor_column]) - current
+        upgrade = result @ weight
+        if best is None:
+            best, best_upgrade = result, upgrade
+        else:
+            better = upgrade > best_upgrade
+            best[better], best_upgrade[better] = result[better], upgrade[better]
+
+    ranking = pd.DataFrame(best, index=positions, columns=list(BATCH_STATS))
+    ranking.insert(0, 'upgrade', best_upgrade)
+    ranking.insert(0, 'slot', np.array(SLOTS, dtype=object)[item_slot[positions]])
+    ranking.insert(0, 'name', items['name'].to_numpy()[positions])
+    ranking.insert(0, 'id', items['id'].to_numpy()[positions])
+    return ranking.sort_values('upgrade', ascending=False, kind='stable')
@@ -0,0 +1,151 @@
+import os
+import shutil
+import struct
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from catalog import get_catalog, load_snapshot, write_snapshot
+from character import Character
+from db import get_engine
+
+# archive is a header followed by records appended one after another
+ROSTER_MAGIC = b'WROS'
+ROSTER_VERSION = 1
+ROSTER_HEADER = struct.Struct('<4sB')
+# length of name, length of data saved by Character.to_bytes
+RECORD_HEADER = struct.Struct('<HI')
+
+
+def _read_records(data):
+    'Name and saved character of every record, later record with the same name wins'
+    magic, version = ROSTER_HEADER.unpack_from(data, 0)
+    if magic != ROSTER_MAGIC:
+        raise ValueError('Not a roster archive')
+    if version > ROSTER_VERSION:
+        raise ValueError('Unsupported roster version: {}'.format(version))
+    records = {}
+    offset = ROSTER_HEADER.size
+    while offset < len(data):
+        name_size, data_size = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        name = data[offset:offset + name_size].decode('utf-8')
+        offset += name_size
+        records[name] = (offset, data_size)
+        offset += data_size
+    return records
+
+
+def _evaluate(chunk, hide_resist):
+    # runs in worker process, items of every save are worn again
+    return [(name, Character.from_bytes(data, replay=True).summary(hide_resist)) for name, data in chunk]
+
+
+def _attach(snapshot):
+    # catalog columns and item deltas are memory-mapped, pages are shared with other workers
+    load_snapshot(*os.path.split(snapshot))
+
+
+def evaluate_roster(characters, processes=None, snapshot=None, chunk_size=32, hide_resist=False):
+    '''
+    Generator of (name, summary) of characters, dict of name -> Character or saved bytes.
+    Characters are built and their items worn again in a process pool, results come
+    in order of completion. Workers memory-map the catalog from snapshot directory
+    (e.g. returned by catalog.write_snapshot), without it the catalog of this process is
+    written to a temporary one. Without processes characters are evaluated here in order.
+    '''
+    saved = [(name, data if isinstance(data, bytes) else data.to_bytes()) for name, data in characters.items()]
+    chunks = [saved[i:i + chunk_size] for i in range(0, len(saved), chunk_size)]
+    if not processes or processes < 2:
+        for chunk in chunks:
+            yield from _evaluate(chunk, hide_resist)
+        return
+
+    temporary = None
+    if snapshot is None:
+        catalog = get_catalog(get_engine)
+        snapshot = catalog.snapshot
+        if snapshot is None:
+            temporary = tempfile.mkdtemp(prefix='catalog')
+            snapshot = write_snapshot(catalog, temporary)
+    try:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_attach, initargs=(snapshot,)) as executor:
+            futures = [executor.submit(_evaluate, chunk, hide_resist) for chunk in chunks]
+            for future in as_completed(futures):
+                yield from future.result()
+    finally:
+        if temporary:
+            shutil.rmtree(temporary, ignore_errors=True)
+
+
+class Roster:
+    'Many saved characters in one append-only archive file'
+    def __init__(self, path='./characters/roster.bin'):
+        self.path = path
+        self.records = None
+
+    def index(self):
+        'Offset and size of every character in archive, read once'
+        if self.records is None:
+            with open(self.path, 'rb') as f_in:
+                self.records = _read_records(f_in.read())
+        return self.records
+
+    def names(self):
+        return list(self.index())
+
+    def save(self, characters):
+        'Write new archive from dict of name -> Character'
+        with open(self.path, 'wb') as f_out:
+            f_out.write(ROSTER_HEADER.pack(ROSTER_MAGIC, ROSTER_VERSION))
+            for name, character in characters.items():
+                self._write_record(f_out, name, character)
+        self.records = None
+
+    def append(self, name, character):
+        'Add or replace one character without rewriting the archive'
+        if not os.path.exists(self.path):
+            return self.save({name: character})
+        with open(self.path, 'ab') as f_out:
+            self._write_record(f_out, name, character)
+        self.records = None
+
+    def add_directory(self, path='./characters'):
+        'Append every character saved with Character.save in directory'
+        for name in sorted(os.listdir(path)):
+            if os.path.join(path, name) != self.path:
+                self.append(name, Character.load(name, path))
+
+    def load(self, name, replay=False):
+        'Random access to one character'
+        offset, size = self.index()[name]
+        with open(self.path, 'rb') as f_in:
+            f_in.seek(offset)
+            return Character.from_bytes(f_in.read(size), replay)
+
+    def load_all(self, replay=False):
+        '''
+        Every character of archive read in one pass, dict of name -> Character.
+        Characters are built in this process, they can not be sent from other
+        processes without being built again, see evaluate for parallel work.
+        '''
+        with open(self.path, 'rb') as f_in:
+            data = f_in.read()
+        self.records = _read_records(data)
+        return {name: Character.from_bytes(data[offset:offset + size], replay)
+                for name, (offset, size) in self.records.items()}
+
+    def evaluate(self, processes=None, snapshot=None, chunk_size=32, hide_resist=False):
+        'evaluate_roster of every character in archive, records are sent to workers as they are saved'
+        with open(self.path, 'rb') as f_in:
+            data = f_in.read()
+        self.records = _read_records(data)
+        saved = {name: data[offset:offset + size] for name, (offset, size) in self.records.items()}
+        return evaluate_roster(saved, processes, snapshot, chunk_size, hide_resist)
+
+    @staticmethod
+    def _write_record(f_out, name, character):
+        name = name.encode('utf-8')
+        data = character.to_bytes()
+        f_out.write(RECORD_HEADER.pack(len(name), len(data)))
+        f_out.write(name)
+        f_out.write(data)
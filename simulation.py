@@ -0,0 +1,152 @@
+'''
+Monte Carlo melee, ranged and mitigation simulation on stats of a Character.
+
+Every fight is a row of swings with fixed weapon speed, all outcomes of all
+fights are rolled at once as numpy arrays. Attack table is one roll per swing:
+miss, dodge, parry, crit, normal hit, chances are in percent as in summary().
+'''
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from evaluation import physical_damage_reduction
+
+# chance to miss a target of the same level, dual wield adds its own penalty
+BASE_MISS = 5.
+DUAL_WIELD_MISS = 19.
+OFFHAND_DAMAGE = .5
+CRIT_MULTIPLIER = 2.
+# attack power adds AP / 14 damage per second of weapon speed
+AP_PER_DPS = 14.
+# every point of defence lowers chance of attacker to hit and crit by 0.04%
+DEFENCE_CHANCE = .04
+
+# damage and speed of a character without weapon
+UNARMED = (1., 2., 2.)
+
+# fights simulated by one task, results do not depend on the number of processes
+CHUNK = 2000
+
+MELEE_MAIN = ('two_hand', 'one-hand')
+MELEE_OFF = ('offhand', 'left-hand')
+RANGED = ('ranged', 'gun', 'bow', 'thrown')
+
+
+def weapon(character, slots):
+    'Min damage, max damage and speed in seconds of the first weapon worn in slots, None if there is none'
+    weapons = character.catalog.group('weapon')
+    for slot in slots:
+        ids = character.items_on.get(slot)
+        if ids is None:
+            continue
+        row = weapons.iloc[character.catalog.position(ids)]
+        dmg_max = sum(row['dmg_max{}'.format(i)] for i in range(1, 4))
+        if dmg_max > 0 and row['delay'] > 0:
+            return float(sum(row['dmg_min{}'.format(i)] for i in range(1, 4))), float(dmg_max), float(row['delay']) / 1000
+    return None
+
+
+def describe(values, duration):
+    'Mean, std and percentiles of per fight totals as per second values'
+    per_second = values / duration
+    p5, p50, p95 = np.percentile(per_second, (5, 50, 95))
+    return {'mean': per_second.mean(), 'std': per_second.std(), 'p5': p5, 'p50': p50, 'p95': p95,
+            'per_fight': per_second}
+
+
+def _swings(rng, fights, duration, dmg_min, dmg_max, speed, bonus, table, multiplier):
+    '''
+    Total damage of every fight of one weapon. table is cumulative chance (0..1)
+    of miss, dodge, parry and crit, outcomes above the last one are normal hits.
+    '''
+    swings = int(duration // speed)
+    if swings == 0:
+        return np.zeros(fights), np.zeros(5, dtype=np.int64)
+    roll = rng.random((fights, swings))
+    outcome = np.searchsorted(table, roll, side='right')
+    damage = rng.uniform(dmg_min, dmg_max, (fights, swings)) + bonus
+    # miss, dodge, parry, crit, hit
+    factor = np.array([0., 0., 0., CRIT_MULTIPLIER, 1.]) * multiplier
+    return (damage * factor[outcome]).sum(axis=1), np.bincount(outcome.ravel(), minlength=5)
+
+
+def _attack_chunk(weapons, fights, duration, seed):
+    rng = np.random.default_rng(seed)
+    total, counts = np.zeros(fights), np.zeros(5, dtype=np.int64)
+    for dmg_min, dmg_max, speed, bonus, table, multiplier in weapons:
+        damage, outcomes = _swings(rng, fights, duration, dmg_min, dmg_max, speed, bonus, table, multiplier)
+        total += damage
+        counts += outcomes
+    return total, counts
+
+
+def _table(miss, dodge, parry, crit):
+    # crit and the rest can not push the table above 100%
+    chances = np.clip([miss, dodge, parry, crit], 0, None) / 100
+    return np.minimum(np.cumsum(chances), 1.)
+
+
+def _run(weapons, fights, duration, seed, processes):
+    'Split fights into chunks with own seeds, run them serially or in a process pool'
+    sizes = [min(CHUNK, fights - start) for start in range(0, fights, CHUNK)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if processes and processes > 1 and len(sizes) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(executor.map(_attack_chunk, [weapons] * len(sizes), sizes,
+                                        [duration] * len(sizes), seeds))
+    else:
+        results = [_attack_chunk(weapons, size, duration, s) for size, s in zip(sizes, seeds)]
+    total = np.concatenate([result[0] for result in results])
+    counts = sum(result[1] for result in results)
+    return total, counts
+
+
+def _outcomes(counts):
+    return dict(zip(('miss', 'dodge', 'parry', 'crit', 'hit'), (counts / max(counts.sum(), 1)).tolist()))
+
+
+def simulate_dps(character, fights=10000, duration=60., ranged=False, target_dodge=5., target_parry=0.,
+                 seed=None, processes=None):
+    '''
+    Damage per second of character against a target of the same level, melee with
+    main and offhand weapons or ranged. Returns mean, std, p5, p50 and p95 of fights,
+    per_fight values and outcomes (share of every attack table result).
+    Same seed gives the same result with any number of processes.
+    '''
+    crit = character.crit
+    if ranged:
+        found = weapon(character, RANGED)
+        if found is None:
+            raise KeyError('No ranged weapon.')
+        weapons = [found + (character.range_attack_power / AP_PER_DPS * found[2],
+                            _table(BASE_MISS - character.hit_chance, target_dodge, 0., crit), 1.)]
+    else:
+        main, off = weapon(character, MELEE_MAIN), weapon(character, MELEE_OFF)
+        main = main if main is not None else UNARMED
+        miss = BASE_MISS + (DUAL_WIELD_MISS if off is not None else 0.) - character.hit_chance
+        table = _table(miss, target_dodge, target_parry, crit)
+        weapons = [main + (character.melee_attack_power / AP_PER_DPS * main[2], table, 1.)]
+        if off is not None:
+            weapons.append(off + (character.melee_attack_power / AP_PER_DPS * off[2], table, OFFHAND_DAMAGE))
+
+    total, counts = _run(weapons, fights, duration, seed, processes)
+    result = describe(total, duration)
+    result['outcomes'] = _outcomes(counts)
+    return result
+
+
+def simulate_mitigation(character, attacker_min=500., attacker_max=700., attacker_speed=2., attacker_level=60,
+                        fights=10000, duration=60., seed=None, processes=None):
+    '''
+    Damage taken per second from a melee attacker, with the character's dodge, parry,
+    defence and armor. Returns the same keys as simulate_dps.
+    '''
+    defence = character.defence * DEFENCE_CHANCE
+    table = _table(BASE_MISS + defence, character.dodge, character.parry, BASE_MISS - defence)
+    reduction = physical_damage_reduction(character.armor, attacker_level)
+    weapons = [(attacker_min, attacker_max, attacker_speed, 0., table, 1 - reduction)]
+
+    total, counts = _run(weapons, fights, duration, seed, processes)
+    result = describe(total, duration)
+    result['outcomes'] = _outcomes(counts)
+    return result
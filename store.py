@@ -0,0 +1,96 @@
+import os
+
+import pandas as pd
+from sqlalchemy import bindparam, create_engine, text
+
+from catalog import BONUS_STATS
+from character import Character
+
+# columns searches filter on, they are not part of human readable form
+FILTER_COLUMNS = ('InventoryType', 'AllowableClass', 'Quality', 'subclass')
+
+# human readable columns search can sort by, every one of them is indexed
+SORT_COLUMNS = ('stamina', 'strenght', 'intellect', 'agility', 'spirit', 'health', 'armor') + BONUS_STATS
+
+TABLE = 'items'
+
+
+def _quote(column):
+    # column names have spaces, e.g. Increase Healing
+    return '"{}"'.format(column)
+
+
+class ItemStore:
+    '''
+    Catalog in human readable form in an indexed SQLite file. Search filters and
+    ORDER BY ... LIMIT run in SQLite, so searches need no catalog in memory.
+    '''
+    def __init__(self, path='./items.sqlite'):
+        if not os.path.exists(path):
+            raise FileNotFoundError('No item store {}, see ItemStore.build'.format(path))
+        self.path = path
+        self.engine = create_engine('sqlite:///{}'.format(path))
+        with self.engine.connect() as conn:
+            columns = [row[1] for row in conn.execute(text('PRAGMA table_info({})'.format(TABLE)))]
+        # columns returned by search, in the same order as Character.search
+        self.columns = [column for column in columns if column not in FILTER_COLUMNS]
+
+    @classmethod
+    def build(cls, character, path='./items.sqlite'):
+        'Write catalog of character (any class and race) to path, existing store is replaced'
+        readable = character.readable_items()
+        items = character.items
+        table = pd.concat([readable, items[list(FILTER_COLUMNS)]], axis=1)
+        if os.path.exists(path):
+            os.remove(path)
+        engine = create_engine('sqlite:///{}'.format(path))
+        # rowid follows catalog row positions, it is used as index of results
+        table.to_sql(TABLE, engine, index=False)
+        with engine.begin() as conn:
+            conn.execute(text('CREATE INDEX search ON {} ({})'.format(TABLE, ', '.join(FILTER_COLUMNS))))
+            conn.execute(text('CREATE INDEX item_id ON {} (id)'.format(TABLE)))
+            for i, column in enumerate(SORT_COLUMNS):
+                conn.execute(text('CREATE INDEX sort_{} ON {} ({})'.format(i, TABLE, _quote(column))))
+            conn.execute(text('ANALYZE'))
+        engine.dispose()
+        return cls(path)
+
+    def search(self, game_class, slot, armor_type='', quality='epic',
+               orderby=['armor'], asc=False,
+               hide_resist=False, hide_additional_spell_power=False, limit=None, offset=0):
+        'Same as Character.search of a character of game_class'
+        game_class = Character.valid_key(game_class, Character.class_map)
+        inventory_types, class_id, quality, subclass = Character.search_filters(game_class, slot, armor_type,
+                                                                                quality, orderby)
+        ascending = asc if isinstance(asc, (list, tuple)) else [asc] * len(orderby)
+
+        query = ['SELECT rowid - 1 AS position, {} FROM {}'.format(', '.join(map(_quote, self.columns)), TABLE),
+                 'WHERE InventoryType IN :types AND Quality = :quality AND AllowableClass IN (-1, :cls)']
+        params = {'types': list(inventory_types), 'quality': quality, 'cls': class_id}
+        if subclass is not None:
+            query.append('AND subclass = :subclass')
+            params['subclass'] = subclass
+        # rowid last so ties keep catalog order, as in Character.top_positions
+        order = ['{} {}'.format(_quote(column), 'ASC' if up else 'DESC') for column, up in zip(orderby, ascending)]
+        query.append('ORDER BY {}'.format(', '.join(order + ['rowid'])))
+        if limit is not None:
+            query.append('LIMIT :limit OFFSET :offset')
+            params.update(limit=limit, offset=offset)
+
+        statement = text('\n'.join(query)).bindparams(bindparam('types', expanding=True))
+        result = pd.read_sql_query(statement, self.engine, params=params, index_col='position')
+        result.index.name = None
+        return Character.hide_columns(result, hide_resist, hide_additional_spell_power)
+
+    def search_pages(self, game_class, slot, armor_type='', quality='epic',
+                     orderby=['armor'], asc=False,
+                     hide_resist=False, hide_additional_spell_power=False, page_size=50):
+        'Same as Character.search_pages, every page is a separate query'
+        offset = 0
+        while True:
+            page = self.search(game_class, slot, armor_type, quality, orderby, asc,
+                               hide_resist, hide_additional_spell_power, page_size, offset)
+            if page.shape[0] == 0:
+                return
+            yield page
+            offset += page_size